@@ -13,6 +13,9 @@ import boto3
 import yaml
 from botocore.exceptions import ClientError
 
+# This works because Python puts the directory of the script it runs on the path.
+from s3_client_config import S3_CLIENT_CONFIG
+
 
 def print_command(command):
     """Print a command with shlex, splitting each option to a separate line."""
@@ -111,7 +114,9 @@ def main():
     args = parser.parse_args()
 
     session = boto3.Session()
-    s3_client = session.client("s3")
+    # The package uploads each use the default transfer settings, which fit in the default
+    # connection pool.
+    s3_client = session.client("s3", config=S3_CLIENT_CONFIG)
 
     if args.variant_config_file:
         print("Using the following additional variant config:")
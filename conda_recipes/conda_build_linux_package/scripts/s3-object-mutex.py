@@ -33,6 +33,9 @@ from urllib.parse import urlparse
 import boto3
 from botocore.exceptions import ClientError
 
+# This works because Python puts the directory of the script it runs on the path.
+from s3_client_config import S3_CLIENT_CONFIG
+
 MUTEX_OBJECT_SUFFIX = ".s3-object-mutex-lock.json"
 MUTEX_TIMEOUT_SECONDS = 900
 MUTEX_ACQUISITION_TIMEOUT_SECONDS = 120
@@ -52,7 +55,8 @@ s3_bucket_name = url.netloc
 s3_prefix = url.path.lstrip("/")
 s3_lock_object = s3_prefix + MUTEX_OBJECT_SUFFIX
 
-s3_client = boto3.client("s3")
+# The mutex makes one request at a time, so the default connection pool is enough.
+s3_client = boto3.client("s3", config=S3_CLIENT_CONFIG)
 
 
 def _get_data_for_lock():
@@ -0,0 +1,12 @@
+"""
+The S3 client settings shared by the scripts of this job.
+"""
+
+from botocore.config import Config
+
+# Adaptive retries slow the requests down on the client when S3 throttles them, and TCP
+# keepalive stops idle connections from being dropped between requests.
+S3_CLIENT_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+)
@@ -0,0 +1,371 @@
+"""
+Benchmarks the copy_s3_prefix_to_job_attachments steps against a local S3 stand-in.
+
+For each scenario, this starts from a fresh pair of source and job attachments buckets in
+a moto server, seeds a synthetic prefix, and runs the CollectObjects, HashObjects,
+DedupeObjects, CopyObjects, and SaveManifest scripts the same way the job runs them. The
+tasks of each step run at the same time, as they would on separate workers. The wall time,
+peak RSS, and S3 request counts of each step are appended as one JSON line per scenario to
+the results file, so that runs before and after a change can be compared.
+
+The moto server and the seeding run in their own processes. A process started by this one
+reports a peak RSS of at least this process's RSS, so this process avoids importing boto3
+or holding any object data.
+
+Requires: boto3, xxhash, and moto[server].
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from pathlib import Path
+
+from scenarios import MIB, SCENARIOS
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+SCRIPTS_DIR = BENCHMARK_DIR.parent / "scripts"
+JA_ROOT_PREFIX = "DeadlineCloud"
+
+parser = argparse.ArgumentParser(prog="run_benchmark.py")
+parser.add_argument(
+    "--scenarios",
+    nargs="+",
+    choices=sorted(SCENARIOS),
+    default=sorted(SCENARIOS),
+    help="The scenarios to run.",
+)
+parser.add_argument(
+    "--scale",
+    type=float,
+    default=1.0,
+    help="A multiplier for the number of objects in each scenario.",
+)
+parser.add_argument("--parallelism", type=int, default=3)
+parser.add_argument(
+    "--results",
+    type=Path,
+    default=Path("benchmark_results.jsonl"),
+    help="The JSON lines file to append the results to.",
+)
+parser.add_argument(
+    "--label", default="", help="A label to tell the runs apart in the results."
+)
+parser.add_argument(
+    "--work-dir",
+    type=Path,
+    default=Path("benchmark_work"),
+    help="The directory for the job workspaces and step logs.",
+)
+parser.add_argument(
+    "--port",
+    type=int,
+    default=0,
+    help="The port for the moto server, which must be free. Defaults to any free port.",
+)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument(
+    "--collect-args", default="", help="Extra options for collect_objects.py."
+)
+parser.add_argument(
+    "--hash-args", default="", help="Extra options for hash_objects.py."
+)
+parser.add_argument(
+    "--copy-args", default="", help="Extra options for copy_objects.py."
+)
+args = parser.parse_args()
+
+
+def free_port():
+    """Returns --port if it's free, or any free port if --port is 0."""
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", args.port))
+        except OSError as exc:
+            print(f"The port {args.port} for the moto server is not free: {exc}")
+            sys.exit(1)
+        return sock.getsockname()[1]
+
+
+port = free_port()
+endpoint_url = f"http://127.0.0.1:{port}"
+# Name the buckets uniquely for each run, so a run never reuses the objects of another
+run_id = uuid.uuid4().hex[:8]
+step_env = {
+    **os.environ,
+    "AWS_ENDPOINT_URL": endpoint_url,
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "PYTHONPATH": str(SCRIPTS_DIR / "shared"),
+    "PYTHONUNBUFFERED": "True",
+}
+for name in ("AWS_PROFILE", "AWS_SESSION_TOKEN"):
+    step_env.pop(name, None)
+
+
+def run_processes(commands, log_dir, step_name):
+    """
+    Runs the commands at the same time, and returns (wall_seconds, peak_rss_bytes) where
+    the peak RSS is the largest of any of the processes.
+    """
+    start_time = time.monotonic()
+    processes = []
+    for i, command in enumerate(commands):
+        log_path = log_dir / f"{step_name}_{i + 1}.log"
+        with open(log_path, "w") as log_fh:
+            processes.append(
+                (
+                    subprocess.Popen(
+                        command, stdout=log_fh, stderr=subprocess.STDOUT, env=step_env
+                    ),
+                    log_path,
+                )
+            )
+    peak_rss_bytes = 0
+    for process, log_path in processes:
+        # os.wait4 gives the resource usage of just this process
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_rss_bytes = max(peak_rss_bytes, rusage.ru_maxrss * 1024)
+        if process.returncode != 0:
+            print(f"{step_name} failed, see {log_path}:")
+            print(log_path.read_text()[-4000:])
+            sys.exit(1)
+    return time.monotonic() - start_time, peak_rss_bytes
+
+
+def request_counts(workspace_path, step_name):
+    """Sums the S3 request counts of all the tasks of a step from their metrics summaries."""
+    counts = {}
+    for path in sorted((workspace_path / "metrics").glob(f"{step_name}*.json")):
+        with open(path) as fh:
+            summary = json.load(fh)
+        for operation, values in summary["operations"].items():
+            # Skip HashData, which HashObjects times itself
+            if operation != "HashData":
+                entry = counts.setdefault(
+                    operation, {"count": 0, "retries": 0, "throttled": 0}
+                )
+                entry["count"] += values["count"]
+                entry["retries"] += values["retries"]
+                entry["throttled"] += values["throttled"]
+    return counts
+
+
+def run_scenario(name):
+    """Seeds the scenario and runs all the steps on it, returning the results."""
+    scenario_dir = (args.work_dir / name).resolve()
+    shutil.rmtree(scenario_dir, ignore_errors=True)
+    workspace_path = scenario_dir / "workspace"
+    log_dir = scenario_dir / "logs"
+    log_dir.mkdir(parents=True)
+
+    src_bucket = f"bench-src-{name.replace('_', '-')}-{run_id}"
+    ja_bucket = f"bench-ja-{name.replace('_', '-')}-{run_id}"
+    print(f"Seeding the {name} scenario...")
+    seed_output = subprocess.check_output(
+        [
+            sys.executable,
+            str(BENCHMARK_DIR / "seed_scenario.py"),
+            name,
+            "--source-bucket",
+            src_bucket,
+            "--ja-bucket",
+            ja_bucket,
+            "--ja-root-prefix",
+            JA_ROOT_PREFIX,
+            "--scale",
+            str(args.scale),
+            "--seed",
+            str(args.seed),
+        ],
+        env=step_env,
+        text=True,
+    )
+    seeded = json.loads(seed_output.splitlines()[-1])
+    print(
+        f"Seeded {seeded['objectCount']} objects in {seeded['totalSize'] / MIB:.1f}MiB"
+    )
+    settings_path = scenario_dir / "job_attachment_settings.json"
+    settings_path.write_text(
+        json.dumps({"s3BucketName": ja_bucket, "rootPrefix": JA_ROOT_PREFIX})
+    )
+
+    copy_source = f"s3://{src_bucket}/data"
+    python = sys.executable
+    workspace = str(workspace_path)
+    parallelism = str(args.parallelism)
+    indexes = [str(i) for i in range(1, args.parallelism + 1)]
+    steps = [
+        (
+            "CollectObjects",
+            [
+                [
+                    python,
+                    str(SCRIPTS_DIR / "collect_objects.py"),
+                    workspace,
+                    "--parallelism",
+                    parallelism,
+                    "--copy-source",
+                    copy_source,
+                    "--job-attachment-settings",
+                    str(settings_path),
+                    *shlex.split(args.collect_args),
+                ]
+            ],
+        ),
+        (
+            "HashObjects",
+            [
+                [
+                    python,
+                    str(SCRIPTS_DIR / "hash_objects.py"),
+                    workspace,
+                    "--index",
+                    index,
+                    "--copy-source",
+                    copy_source,
+                    # Don't carry hashes over from other runs, unless --hash-args asks to
+                    "--hash-cache",
+                    "",
+                    *shlex.split(args.hash_args),
+                ]
+                for index in indexes
+            ],
+        ),
+        (
+            "DedupeObjects",
+            [
+                [
+                    python,
+                    str(SCRIPTS_DIR / "dedupe_objects.py"),
+                    workspace,
+                    "--parallelism",
+                    parallelism,
+                ]
+            ],
+        ),
+        (
+            "CopyObjects",
+            [
+                [
+                    python,
+                    str(SCRIPTS_DIR / "copy_objects.py"),
+                    workspace,
+                    "--index",
+                    index,
+                    "--copy-source",
+                    copy_source,
+                    *shlex.split(args.copy_args),
+                ]
+                for index in indexes
+            ],
+        ),
+        (
+            "SaveManifest",
+            [
+                [
+                    python,
+                    str(SCRIPTS_DIR / "save_manifest.py"),
+                    workspace,
+                    "--parallelism",
+                    parallelism,
+                    "--copy-source",
+                    copy_source,
+                ]
+            ],
+        ),
+    ]
+    stage_results = {}
+    for step_name, commands in steps:
+        wall_seconds, peak_rss_bytes = run_processes(commands, log_dir, step_name)
+        stage_results[step_name] = {
+            "wallSeconds": round(wall_seconds, 3),
+            "peakRssMiB": round(peak_rss_bytes / MIB, 1),
+            "requests": request_counts(workspace_path, step_name),
+        }
+        print(
+            f"  {step_name}: {wall_seconds:.2f}s, peak RSS {peak_rss_bytes / MIB:.1f}MiB, "
+            + f"{sum(v['count'] for v in stage_results[step_name]['requests'].values())} requests"
+        )
+    return {
+        "scenario": name,
+        **seeded,
+        "stages": stage_results,
+        "totalWallSeconds": round(
+            sum(stage["wallSeconds"] for stage in stage_results.values()), 3
+        ),
+    }
+
+
+def git_commit():
+    """Returns the git commit of the benchmarked scripts, if they're in a git repository."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_moto_server():
+    """
+    Starts a moto server in its own process, and waits for it to accept requests. Fails if
+    the server exits first, for example when another process took the port.
+    """
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    with open(args.work_dir / "moto_server.log", "w") as log_fh:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "moto.server", "--port", str(port)],
+            stdout=log_fh,
+            stderr=subprocess.STDOUT,
+        )
+    for _ in range(100):
+        if server.poll() is not None:
+            break
+        try:
+            urllib.request.urlopen(endpoint_url, timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    print(f"The moto server did not start, see {args.work_dir / 'moto_server.log'}")
+    sys.exit(1)
+
+
+server = start_moto_server()
+try:
+    run_info = {
+        "label": args.label,
+        "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(
+            timespec="seconds"
+        ),
+        "commit": git_commit(),
+        "parallelism": args.parallelism,
+        "scale": args.scale,
+        "collectArgs": args.collect_args,
+        "hashArgs": args.hash_args,
+        "copyArgs": args.copy_args,
+    }
+    for name in args.scenarios:
+        result = {**run_info, **run_scenario(name)}
+        with open(args.results, "a") as fh:
+            fh.write(json.dumps(result) + "\n")
+        print(
+            f"{name}: {result['totalWallSeconds']:.2f}s in total, appended to {args.results}"
+        )
+finally:
+    server.terminate()
+    server.wait()
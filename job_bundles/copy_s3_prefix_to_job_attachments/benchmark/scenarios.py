@@ -0,0 +1,44 @@
+"""
+The synthetic prefixes that the benchmark seeds. Each size distribution takes a seeded
+random.Random and a scale factor, and returns the list of object sizes.
+"""
+
+KIB = 1024
+MIB = 1024 * 1024
+
+
+def tiny_files(rng, scale):
+    """Many files of up to 4KiB."""
+    return [rng.randint(0, 4 * KIB) for _ in range(int(5000 * scale))]
+
+
+def huge_files(rng, scale):
+    """A few files above the ranged GET and multipart thresholds."""
+    return [rng.randint(96 * MIB, 160 * MIB) for _ in range(max(1, int(4 * scale)))]
+
+
+def heavy_tail(rng, scale):
+    """Pareto distributed sizes, mostly small with a few very large files."""
+    return [
+        min(int(4 * KIB * rng.paretovariate(1.1)), 256 * MIB)
+        for _ in range(int(2000 * scale))
+    ]
+
+
+def mixed_sizes(rng, scale):
+    """A mix of small and medium files."""
+    return [
+        rng.choice([0, 100, 10 * KIB, 200 * KIB, 2 * MIB, 12 * MIB])
+        for _ in range(int(2000 * scale))
+    ]
+
+
+# Each scenario is (size distribution, fraction of objects pre-tagged with their hash,
+# fraction of objects already in the job attachments Data prefix).
+SCENARIOS = {
+    "tiny_files": (tiny_files, 0.0, 0.0),
+    "huge_files": (huge_files, 0.0, 0.0),
+    "heavy_tail": (heavy_tail, 0.0, 0.0),
+    "partially_tagged": (mixed_sizes, 0.5, 0.0),
+    "mostly_existing": (mixed_sizes, 0.0, 0.9),
+}
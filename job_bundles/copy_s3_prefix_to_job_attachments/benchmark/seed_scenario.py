@@ -0,0 +1,79 @@
+"""
+Seeds the source and job attachments buckets of one benchmark scenario, and prints
+the object count and total size as JSON. run_benchmark.py runs this in its own process,
+so that the memory it uses doesn't count towards the peak RSS of the steps.
+"""
+
+import argparse
+import json
+import random
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from xxhash import xxh3_128
+
+from scenarios import SCENARIOS
+
+parser = argparse.ArgumentParser(prog="seed_scenario.py")
+parser.add_argument("scenario", choices=sorted(SCENARIOS))
+parser.add_argument("--source-bucket", required=True)
+parser.add_argument("--ja-bucket", required=True)
+parser.add_argument("--ja-root-prefix", required=True)
+parser.add_argument("--scale", type=float, default=1.0)
+parser.add_argument("--seed", type=int, default=1)
+args = parser.parse_args()
+
+s3_client = boto3.client("s3")
+
+size_distribution, tagged_fraction, existing_fraction = SCENARIOS[args.scenario]
+rng = random.Random(f"{args.seed}-{args.scenario}")
+objects = []
+for i, size in enumerate(size_distribution(rng, args.scale)):
+    directory = "".join(f"d{rng.randrange(8)}/" for _ in range(rng.randint(0, 3)))
+    objects.append(
+        (
+            f"data/{directory}file_{i:06d}.bin",
+            size,
+            rng.random() < tagged_fraction,
+            rng.random() < existing_fraction,
+        )
+    )
+
+for bucket in (args.source_bucket, args.ja_bucket):
+    s3_client.create_bucket(Bucket=bucket)
+
+
+def put_object(i):
+    key, size, tagged, existing = objects[i]
+    data = random.Random(f"{args.seed}-{args.scenario}-{i}").randbytes(size)
+    response = s3_client.put_object(Bucket=args.source_bucket, Key=key, Body=data)
+    ja_hash = xxh3_128(data).hexdigest()
+    if tagged:
+        # The same tag that HashObjects saves
+        etag_and_hash = b64encode(f"{response['ETag']}|{ja_hash}".encode()).decode()
+        s3_client.put_object_tagging(
+            Bucket=args.source_bucket,
+            Key=key,
+            Tagging={
+                "TagSet": [
+                    {"Key": "B64DeadlineJobAttachmentsXXH128", "Value": etag_and_hash}
+                ]
+            },
+        )
+    if existing:
+        s3_client.put_object(
+            Bucket=args.ja_bucket,
+            Key=f"{args.ja_root_prefix}/Data/{ja_hash}.xxh128",
+            Body=data,
+        )
+
+
+with ThreadPoolExecutor(max_workers=16) as executor:
+    list(executor.map(put_object, range(len(objects))))
+
+print(
+    json.dumps(
+        {"objectCount": len(objects), "totalSize": sum(obj[1] for obj in objects)}
+    )
+)
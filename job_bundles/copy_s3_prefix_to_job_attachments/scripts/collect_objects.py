@@ -1,68 +1,687 @@
 import argparse
+import datetime
+import gzip
+import heapq
 import json
 import os
+import shutil
 import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from pprint import pprint
-from urllib.parse import urlparse
+from uuid import uuid4
 
 import boto3
 
+# This works because the "SharedLibrary" job environment sets PYTHONPATH.
+from copy_source import local_etag, parse_copy_source, snapshot_prefix
+from manifest_writer import path_sort_key
+from metrics import Metrics, metrics_path
+from s3_client import create_s3_client, transfer_config
+from s3_inventory import (
+    find_inventory_manifest,
+    inventory_creation_time,
+    iter_inventory_file,
+    load_inventory_manifest,
+)
+from shard_records import (
+    INDEX_SUFFIX,
+    RecordWriter,
+    carried_forward_path,
+    decode_record,
+    encode_record,
+    iter_records,
+    listed_mtime,
+    shard_path,
+)
+from task_journal import delete_journals
+from work_claims import (
+    DEFAULT_CLAIM_TIMEOUT_SECONDS,
+    file_claims_dir,
+    save_work_chunks,
+)
+
+# When a listing is truncated after its first page, the rest of the key range gets split
+# on the character following the prefix, so that the pieces can be listed concurrently.
+# Python string comparison matches the UTF-8 binary order that S3 lists keys in.
+LIST_SPLIT_CHARACTERS = sorted(
+    "!-.0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+)
+# Objects estimated to cost more than 1/LPT_GRANULARITY of the mean task cost
+# get sorted and scheduled first.
+LPT_GRANULARITY = 50
+# The estimated memory for each listed object held in a sorted run, on top of the lengths of
+# its encoded record and sort key, for the tuple and bytes objects that hold them.
+RUN_ENTRY_OVERHEAD_BYTES = 150
+
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--parallelism", type=int, required=True)
-parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--copy-source",
+    type=str,
+    required=True,
+    help="The s3:// URL of the prefix to copy, or the absolute path of a local directory on shared storage.",
+)
+parser.add_argument(
+    "--list-concurrency",
+    type=int,
+    default=32,
+    help="How many ListObjectsV2 requests, or local directory scans, to run at the same time.",
+)
+parser.add_argument(
+    "--list-discovery-depth",
+    type=int,
+    default=3,
+    help="How many '/' levels below the prefix to discover as separate listing partitions, "
+    + "when their listing has more than one page.",
+)
+parser.add_argument(
+    "--object-overhead-seconds",
+    type=float,
+    default=0.05,
+    help="The estimated per-object cost of the S3 requests, for balancing the tasks.",
+)
+parser.add_argument(
+    "--throughput-bytes-per-second",
+    type=float,
+    default=100 * 1024 * 1024,
+    help="The estimated per-task transfer throughput, for balancing the tasks.",
+)
+parser.add_argument(
+    "--snapshot-mode",
+    choices=["full", "incremental"],
+    default="full",
+    help="Whether to process all the objects, or only the ones that changed since the previous snapshot of the prefix.",
+)
+parser.add_argument(
+    "--job-attachment-settings",
+    type=Path,
+    help="A JSON file with the job attachments s3BucketName and rootPrefix, to use instead of "
+    + "getting them from the queue when running outside of a Deadline Cloud job.",
+)
+parser.add_argument(
+    "--chunks-per-task",
+    type=int,
+    default=1,
+    help="How many chunks to split the objects into for each task. With more than one, the tasks "
+    + "claim chunks until none are left instead of each processing a fixed shard.",
+)
+parser.add_argument(
+    "--claim-method",
+    choices=["s3", "file"],
+    default="s3",
+    help="Whether the tasks claim chunks with conditional writes to the job attachments bucket, "
+    + "or with lock files in the workspace, which must be on a shared file system.",
+)
+parser.add_argument(
+    "--claim-timeout-seconds",
+    type=int,
+    default=DEFAULT_CLAIM_TIMEOUT_SECONDS,
+    help="How long a chunk's claim lasts without being renewed, before another task can take over "
+    + "the chunk from a task that was lost.",
+)
+parser.add_argument(
+    "--memory-budget-mb",
+    type=int,
+    default=1024,
+    help="How many MB of listed objects to hold in memory before spilling them to a sorted run on disk.",
+)
+parser.add_argument(
+    "--s3-inventory",
+    type=str,
+    default="",
+    help="The s3:// URL of an S3 Inventory manifest.json of the source bucket, or the prefix of an "
+    + "inventory configuration to use its most recent report, to read the objects from instead of listing them.",
+)
 args = parser.parse_args()
 
+# Load the job attachments settings file before changing into the workspace, in case it's a relative path
+ja_settings = None
+if args.job_attachment_settings:
+    with open(args.job_attachment_settings) as fh:
+        ja_settings = json.load(fh)
+
 # Initialize the workspace
 os.makedirs(args.workspace_path, exist_ok=True)
 os.chdir(args.workspace_path)
 
 session = boto3.Session()
-deadline_client = session.client("deadline")
-s3_client = session.client("s3")
+s3_client = create_s3_client(session, args.list_concurrency)
+metrics = Metrics("CollectObjects")
+metrics.instrument_client(s3_client)
 
-# Get the queue and save it into the workspace
-response = deadline_client.get_queue(
-    farmId=os.environ["DEADLINE_FARM_ID"], queueId=os.environ["DEADLINE_QUEUE_ID"]
-)
+# Get the queue and save its job attachments settings into the workspace
+if ja_settings is None:
+    deadline_client = session.client("deadline")
+    response = deadline_client.get_queue(
+        farmId=os.environ["DEADLINE_FARM_ID"], queueId=os.environ["DEADLINE_QUEUE_ID"]
+    )
+    ja_settings = response["jobAttachmentSettings"]
 with open(args.workspace_path / "job_attachment_settings.json", "w") as fh:
-    json.dump(response["jobAttachmentSettings"], fh)
+    json.dump(ja_settings, fh)
 
-# Split the S3 copy source into bucket and prefix
-url = urlparse(args.copy_source, allow_fragments=False)
-if url.scheme != "s3":
-    print(f"openjd_fail: Input S3 prefix {args.copy_source} is not an s3:// URL")
+# Split the S3 copy source into bucket and prefix. A local directory has no bucket.
+try:
+    s3_bucket_name, s3_prefix = parse_copy_source(args.copy_source)
+except ValueError as exc:
+    print(f"openjd_fail: {exc}")
     sys.exit(1)
-s3_bucket_name = url.netloc
-s3_prefix = url.path.strip("/")
-
-# Collect all the S3 objects under the prefix, skipping any
-# that end with "/" as those are directory markers.
-s3_objects = []
-paginator = s3_client.get_paginator("list_objects_v2")
-for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f"{s3_prefix}/"):
-    s3_objects.extend(
+if s3_bucket_name is None and not os.path.isdir(f"/{s3_prefix}"):
+    print(f"openjd_fail: The copy source /{s3_prefix} is not a directory")
+    sys.exit(1)
+ja_s3_bucket_name = ja_settings["s3BucketName"]
+ja_root_prefix = ja_settings["rootPrefix"]
+
+# Load the S3 Inventory manifest to read the objects from
+inventory_manifest = None
+if args.s3_inventory:
+    if s3_bucket_name is None:
+        print("openjd_fail: An S3 Inventory can only be used with an S3 copy source")
+        sys.exit(1)
+    try:
+        inventory_bucket, inventory_key = find_inventory_manifest(
+            s3_client, args.s3_inventory
+        )
+        inventory_manifest = load_inventory_manifest(
+            s3_client, inventory_bucket, inventory_key, s3_bucket_name
+        )
+    except ValueError as exc:
+        print(f"openjd_fail: {exc}")
+        sys.exit(1)
+    if inventory_manifest["fileFormat"] == "Parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            print(
+                "openjd_fail: A Parquet S3 Inventory requires the pyarrow package, add it to the CondaPackages job parameter."
+            )
+            sys.exit(1)
+    inventory_created = inventory_creation_time(inventory_manifest)
+    inventory_age_hours = (
+        datetime.datetime.now(tz=datetime.timezone.utc) - inventory_created
+    ).total_seconds() / 3600
+    print(
+        f"openjd_status: Reading the objects from the S3 Inventory s3://{inventory_bucket}/{inventory_key} created {inventory_created.isoformat(timespec='minutes')}"
+    )
+    # S3 can't list only the objects added after a given time, so those are left out
+    print(
+        f"WARNING: The S3 Inventory report is {inventory_age_hours:.1f} hours old. Objects added to s3://{s3_bucket_name}/{s3_prefix} since it was created are not in the report, and will be left out of the manifest. Leave the S3Inventory job parameter empty to list the prefix instead."
+    )
+
+# The journals of earlier HashObjects and CopyObjects tasks don't apply to the new shards
+delete_journals(args.workspace_path)
+# With chunks, the tasks claim the shards dynamically instead of one shard each
+shard_count = args.parallelism * args.chunks_per_task
+claim_prefix = None
+if args.chunks_per_task > 1:
+    if args.claim_method == "s3":
+        claim_prefix = f"{ja_root_prefix}/Claims/{uuid4().hex}"
+    else:
+        shutil.rmtree(file_claims_dir(args.workspace_path), ignore_errors=True)
+save_work_chunks(
+    args.workspace_path,
+    args.parallelism,
+    shard_count,
+    args.claim_method,
+    claim_prefix,
+    args.claim_timeout_seconds,
+)
+
+
+def download_previous_snapshot():
+    """
+    Finds the most recent snapshot of the prefix that SaveManifest saved the object records for,
+    and downloads them into the workspace. Returns the path of the compressed records, or None
+    if there is no previous snapshot.
+    """
+    previous_snapshot_prefix = (
+        f"{snapshot_prefix(ja_root_prefix, s3_bucket_name, s3_prefix)}/"
+    )
+    # The timestamp at the start of each file name sorts in the listing order. The delimiter
+    # leaves out the snapshots of longer prefixes.
+    latest_key = None
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=ja_s3_bucket_name, Prefix=previous_snapshot_prefix, Delimiter="/"
+    ):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("-objects.jsonl.gz"):
+                latest_key = obj["Key"]
+    if latest_key is None:
+        return None
+    print(f"Loading the previous snapshot s3://{ja_s3_bucket_name}/{latest_key}")
+    compressed_path = args.workspace_path / "previous_snapshot.jsonl.gz"
+    s3_client.download_file(
+        ja_s3_bucket_name,
+        latest_key,
+        str(compressed_path),
+        Config=transfer_config(args.list_concurrency),
+    )
+    return compressed_path
+
+
+# In incremental mode, the listing gets compared against the object records of the previous
+# snapshot to carry forward the ones that are unchanged.
+previous_snapshot_path = None
+if args.snapshot_mode == "incremental":
+    previous_snapshot_path = download_previous_snapshot()
+    if previous_snapshot_path is None:
+        print("There is no previous snapshot of the prefix, processing all the objects")
+
+
+def is_unchanged(s3_object, previous_object):
+    """Returns whether the object's size, etag, and mtime are the same as in its previous record."""
+    return (
+        previous_object["size"] == s3_object["size"]
+        and previous_object["etag"] == s3_object["etag"]
+        and listed_mtime(previous_object) == s3_object["mtime"]
+    )
+
+
+def list_partition_page(partition, continuation_token):
+    """
+    Runs a single ListObjectsV2 request for a listing partition, and returns a tuple
+    (objects, follow_up_requests). The partition is a dict with the listing "prefix",
+    its "depth" below the copy source prefix, whether to list it with the "/" "delimiter",
+    and optionally a key range that starts after "start_after" and ends at "end_at"
+    inclusive. Each follow up request is a (partition, continuation_token) tuple.
+
+    A partition is listed flat first, so that a prefix with a single page of objects
+    takes a single request. Only when that first page is truncated does the rest of its
+    key range get divided, by listing it with a delimiter within the discovery depth so
+    that each sub-prefix becomes its own partition, or by splitting it on the character
+    following the prefix below that.
+    """
+    prefix = partition["prefix"]
+    end_at = partition.get("end_at")
+    kwargs = {"Bucket": s3_bucket_name, "Prefix": prefix}
+    if partition.get("delimiter"):
+        kwargs["Delimiter"] = "/"
+    if continuation_token:
+        kwargs["ContinuationToken"] = continuation_token
+    elif partition.get("start_after"):
+        kwargs["StartAfter"] = partition["start_after"]
+    response = s3_client.list_objects_v2(**kwargs)
+
+    contents = response.get("Contents", [])
+    common_prefixes = [v["Prefix"] for v in response.get("CommonPrefixes", [])]
+    reached_end = not response["IsTruncated"]
+    if end_at is not None:
+        if (contents and contents[-1]["Key"] > end_at) or (
+            common_prefixes and common_prefixes[-1] > end_at
+        ):
+            reached_end = True
+        contents = [obj for obj in contents if obj["Key"] <= end_at]
+        common_prefixes = [v for v in common_prefixes if v <= end_at]
+
+    # Skip any objects that end with "/" as those are directory markers.
+    objects = [
         {
             "key": obj["Key"],
             "size": obj["Size"],
             "etag": obj["ETag"],
             "mtime": int(obj["LastModified"].timestamp() * 1e9),
         }
-        for obj in page["Contents"]
+        for obj in contents
         if not obj["Key"].endswith("/")
+    ]
+    follow_up_requests = [
+        ({"prefix": sub_prefix, "depth": partition["depth"] + 1}, None)
+        for sub_prefix in common_prefixes
+    ]
+
+    if not reached_end:
+        # When the page ends with a sub-prefix, the next range has to start after all
+        # the keys within it, not just after the sub-prefix itself.
+        last_listed = max(
+            contents[-1]["Key"] if contents else "",
+            common_prefixes[-1] + "\U0010ffff" if common_prefixes else "",
+        )
+        split_boundaries = [
+            prefix + c
+            for c in LIST_SPLIT_CHARACTERS
+            if prefix + c > last_listed and (end_at is None or prefix + c < end_at)
+        ]
+        if (
+            continuation_token is None
+            and not partition.get("delimiter")
+            and partition["depth"] < args.list_discovery_depth
+        ):
+            # This is the first page of a large partition within the discovery depth,
+            # discover the sub-prefixes in the rest of its key range. When the page ended
+            # within a sub-prefix, that sub-prefix continues as its own partition, and
+            # the discovery starts after all the keys within it.
+            discovery_start_after = last_listed
+            sub_path, separator, _ = last_listed[len(prefix) :].partition("/")
+            if separator:
+                sub_prefix = f"{prefix}{sub_path}/"
+                follow_up_requests.append(
+                    (
+                        {
+                            "prefix": sub_prefix,
+                            "depth": partition["depth"] + 1,
+                            "start_after": last_listed,
+                        },
+                        None,
+                    )
+                )
+                discovery_start_after = sub_prefix + "\U0010ffff"
+            follow_up_requests.append(
+                (
+                    {
+                        **partition,
+                        "delimiter": True,
+                        "start_after": discovery_start_after,
+                    },
+                    None,
+                )
+            )
+        elif continuation_token is None and split_boundaries:
+            # This is the first page of a large partition, split the rest of its key range
+            # on the character after the prefix so the pieces are listed concurrently.
+            range_starts = [last_listed] + split_boundaries
+            range_ends = split_boundaries + [end_at]
+            follow_up_requests.extend(
+                (
+                    {**partition, "start_after": start_after, "end_at": range_end},
+                    None,
+                )
+                for start_after, range_end in zip(range_starts, range_ends)
+            )
+        else:
+            follow_up_requests.append((partition, response["NextContinuationToken"]))
+
+    return objects, follow_up_requests
+
+
+def scan_directory(directory_path):
+    """
+    Scans a single directory of a local copy source, and returns a tuple (objects, follow_up_requests)
+    like list_partition_page. Each follow up request is a (directory_path,) tuple for a subdirectory.
+    Symbolic links to directories are not followed, so that the walk can't loop.
+    """
+    objects = []
+    follow_up_requests = []
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                follow_up_requests.append((entry.path,))
+            elif entry.is_file():
+                stat_result = entry.stat()
+                objects.append(
+                    {
+                        "key": entry.path[1:],
+                        "size": stat_result.st_size,
+                        "etag": local_etag(stat_result),
+                        "mtime": stat_result.st_mtime_ns,
+                    }
+                )
+    return objects, follow_up_requests
+
+
+def estimate_cost(s3_object):
+    """
+    Estimates how many seconds a HashObjects/CopyObjects task will spend on an object,
+    combining the fixed overhead of its S3 requests with the time to transfer its bytes.
+    """
+    return (
+        args.object_overhead_seconds
+        + s3_object["size"] / args.throughput_bytes_per_second
+    )
+
+
+# Collect all the S3 objects under the prefix, running the ListObjectsV2 requests
+# for the different partitions concurrently. For a local directory, scan its
+# subdirectories concurrently instead, and with an S3 Inventory, read its data files
+# concurrently instead. The listed objects are held in memory up to the
+# memory budget, then sorted in manifest order and spilled to a run file in the workspace,
+# so that the memory use doesn't grow with the number of objects.
+memory_budget_bytes = args.memory_budget_mb * 1024 * 1024
+run_paths = []
+run_entries = []
+run_bytes = 0
+first_objects = []
+
+
+def spill_run():
+    """Sorts the listed objects held in memory, and writes them to a new run file."""
+    global run_entries, run_bytes
+    run_entries.sort(key=lambda entry: entry[0])
+    run_path = args.workspace_path / f"listing_run_{len(run_paths) + 1}.jsonl"
+    with open(run_path, "wb") as fh:
+        fh.writelines(line for _, line in run_entries)
+    run_paths.append(run_path)
+    run_entries = []
+    run_bytes = 0
+
+
+listing_lock = threading.Lock()
+
+
+def add_listed_objects(objects):
+    """Adds a page of listed objects to the run in memory, and spills it if it's over the budget."""
+    global run_bytes
+    with listing_lock:
+        metrics.add_progress(
+            objects=len(objects),
+            byte_count=sum(s3_object["size"] for s3_object in objects),
+        )
+        for s3_object in objects:
+            sort_key = path_sort_key(s3_object["key"])
+            line = encode_record(s3_object)
+            run_entries.append((sort_key, line))
+            run_bytes += len(sort_key) + len(line) + RUN_ENTRY_OVERHEAD_BYTES
+        if len(first_objects) < 20:
+            first_objects.extend(objects[: 20 - len(first_objects)])
+        if run_bytes >= memory_budget_bytes:
+            spill_run()
+
+
+def read_inventory_file(i, file_entry):
+    """Reads the objects under the prefix from a data file of the S3 Inventory."""
+    for objects in iter_inventory_file(
+        s3_client,
+        inventory_manifest,
+        file_entry["key"],
+        f"{s3_prefix}/",
+        args.workspace_path / f"inventory_file_{i}.parquet",
+        # The data files download in parallel, so each one gets a single connection
+        download_config=transfer_config(1),
+    ):
+        add_listed_objects(objects)
+
+
+if inventory_manifest is not None:
+    # Read the data files of the inventory concurrently
+    with ThreadPoolExecutor(max_workers=args.list_concurrency) as executor:
+        for _ in executor.map(
+            read_inventory_file,
+            range(len(inventory_manifest["files"])),
+            inventory_manifest["files"],
+        ):
+            pass
+else:
+    if s3_bucket_name is None:
+        list_function = scan_directory
+        first_request = (f"/{s3_prefix}",)
+    else:
+        list_function = list_partition_page
+        first_request = ({"prefix": f"{s3_prefix}/", "depth": 0}, None)
+    with ThreadPoolExecutor(max_workers=args.list_concurrency) as executor:
+        pending = {executor.submit(list_function, *first_request)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                objects, follow_up_requests = future.result()
+                pending.update(
+                    executor.submit(list_function, *request)
+                    for request in follow_up_requests
+                )
+                add_listed_objects(objects)
+
+
+def iter_run(run_path):
+    """Yields (sort_key, line) for the records of a run file."""
+    with open(run_path, "rb") as fh:
+        for line in fh:
+            yield path_sort_key(decode_record(line)["key"]), line
+
+
+# When the listing fit in the memory budget, sort it in memory. Otherwise, spill the rest and
+# merge the sorted runs as a stream.
+if run_paths:
+    spill_run()
+    print(
+        f"Spilled the listing to {len(run_paths)} sorted runs with a memory budget of {args.memory_budget_mb}MB"
     )
+    listed_entries = heapq.merge(
+        *(iter_run(run_path) for run_path in run_paths), key=lambda entry: entry[0]
+    )
+else:
+    run_entries.sort(key=lambda entry: entry[0])
+    listed_entries = iter(run_entries)
+
 
-total_size = sum(obj["size"] for obj in s3_objects)
+def iter_previous_snapshot():
+    """Yields (sort_key, record) for the records of the previous snapshot."""
+    if previous_snapshot_path is None:
+        return
+    with gzip.open(previous_snapshot_path, "rb") as fh:
+        for line in fh:
+            previous_object = decode_record(line)
+            yield path_sort_key(previous_object["key"]), previous_object
+
+
+# SaveManifest saved the records of the previous snapshot in manifest order, the same order
+# as the sorted listing, so a single pass over both finds the unchanged objects. These are
+# carried forward in that order, so the carried forward file is sorted like the task shards.
+# The rest are streamed into a spool file in the workspace to split between the shards.
+spool_path = args.workspace_path / "listing_spool.jsonl"
+total_count = 0
+total_size = 0
+total_cost = 0.0
+carried_forward_count = 0
+carried_forward_size = 0
+previous_entries = iter_previous_snapshot()
+previous_entry = next(previous_entries, None)
+with RecordWriter(spool_path) as spool_writer, RecordWriter(
+    carried_forward_path(args.workspace_path)
+) as carried_forward_writer:
+    for sort_key, line in listed_entries:
+        s3_object = decode_record(line)
+        while previous_entry is not None and previous_entry[0] < sort_key:
+            previous_entry = next(previous_entries, None)
+        if (
+            previous_entry is not None
+            and previous_entry[0] == sort_key
+            and is_unchanged(s3_object, previous_entry[1])
+        ):
+            carried_forward_writer.write(previous_entry[1])
+            carried_forward_count += 1
+            carried_forward_size += s3_object["size"]
+            continue
+        spool_writer.write(s3_object)
+        total_size += s3_object["size"]
+        total_cost += estimate_cost(s3_object)
+        total_count += 1
+previous_entries.close()
+del run_entries
+for run_path in run_paths:
+    os.remove(run_path)
+if previous_snapshot_path is not None:
+    os.remove(previous_snapshot_path)
+    print(
+        f"openjd_status: Carrying forward {carried_forward_count} unchanged objects in {carried_forward_size / 1024 / 1024:.2f}MB from the previous snapshot"
+    )
 print(
-    f"openjd_status: Collected {len(s3_objects)} objects in {total_size / 1024 / 1024:.2f}MB containing the bucket prefix"
+    f"openjd_status: Collected {total_count} objects in {total_size / 1024 / 1024:.2f}MB containing the {'directory' if s3_bucket_name is None else 'bucket prefix'}"
 )
-print("The first 20 objects:")
-pprint(s3_objects[:20])
+print("The first 20 objects listed:")
+pprint(first_objects)
+
+# Open all the shard files, to stream the records into them.
+shard_writers = [
+    RecordWriter(shard_path(args.workspace_path, i + 1)) for i in range(shard_count)
+]
+shard_summaries = [
+    {"index": i + 1, "objectCount": 0, "totalSize": 0, "estimatedCost": 0.0}
+    for i in range(shard_count)
+]
+# Each shard's heap entry is (estimated_cost, object_count, index), so popping it gives the
+# shard with the least work assigned so far.
+shard_heap = [(0.0, 0, i) for i in range(shard_count)]
+
 
-# Sort by size and then deal the S3 objects to the tasks.
-# This will roughly distribute by both amount of data and file count.
-s3_objects.sort(key=lambda v: v["size"])
-for i in range(args.parallelism):
-    with open(args.workspace_path / f"s3_objects_{i + 1}.json", "w") as fh:
-        json.dump(s3_objects[i :: args.parallelism], fh)
+def write_object_to_shard(s3_object):
+    """Writes the object to the least loaded shard."""
+    shard_cost, object_count, i = heapq.heappop(shard_heap)
+    shard_writers[i].write(s3_object)
+    cost = estimate_cost(s3_object)
+    summary = shard_summaries[i]
+    summary["objectCount"] += 1
+    summary["totalSize"] += s3_object["size"]
+    summary["estimatedCost"] += cost
+    heapq.heappush(shard_heap, (shard_cost + cost, object_count + 1, i))
+
+
+# Use longest processing time (LPT) first scheduling for the expensive objects. There are at
+# most shard_count * LPT_GRANULARITY of them, so they fit in memory to sort. The remaining
+# objects are each cheaper than 1/LPT_GRANULARITY of a shard's mean cost, so streaming them
+# from the spool to the least loaded shard keeps the slowest shard close to the mean.
+large_cost_threshold = total_cost / (shard_count * LPT_GRANULARITY)
+large_objects = [
+    s3_object
+    for s3_object in iter_records(spool_path)
+    if estimate_cost(s3_object) >= large_cost_threshold
+]
+large_objects.sort(key=estimate_cost, reverse=True)
+for s3_object in large_objects:
+    write_object_to_shard(s3_object)
+del large_objects
+for s3_object in iter_records(spool_path):
+    if estimate_cost(s3_object) < large_cost_threshold:
+        write_object_to_shard(s3_object)
+
+for writer in shard_writers:
+    writer.close()
+os.remove(spool_path)
+os.remove(f"{spool_path}{INDEX_SUFFIX}")
+
+# Save the per-task cost summary into the workspace
+mean_cost = total_cost / shard_count
+max_cost = max(summary["estimatedCost"] for summary in shard_summaries)
+with open(args.workspace_path / "shard_costs.json", "w") as fh:
+    json.dump(
+        {
+            "costModel": {
+                "objectOverheadSeconds": args.object_overhead_seconds,
+                "throughputBytesPerSecond": args.throughput_bytes_per_second,
+            },
+            "meanEstimatedCost": mean_cost,
+            "maxEstimatedCost": max_cost,
+            "shards": shard_summaries,
+        },
+        fh,
+        indent=1,
+    )
+print(f"Estimated cost of each {'task' if args.chunks_per_task == 1 else 'chunk'}:")
+for summary in shard_summaries:
+    print(
+        f"  {summary['index']}: {summary['estimatedCost']:.1f}s for {summary['objectCount']} objects in {summary['totalSize'] / 1024 / 1024:.2f}MB"
+    )
+if args.chunks_per_task > 1:
+    print(
+        f"openjd_status: Split {total_count} objects into {shard_count} chunks for {args.parallelism} tasks to claim"
+    )
+elif mean_cost > 0:
+    print(
+        f"openjd_status: Distributed {total_count} objects to {args.parallelism} tasks, the slowest task is estimated {100 * (max_cost / mean_cost - 1):.1f}% above the mean"
+    )
+if inventory_manifest is not None:
+    # Keep the warning in the final status, where it's visible in the task's status message
+    print(
+        f"openjd_status: Collected {total_count} objects from the S3 Inventory report of {inventory_created.isoformat(timespec='minutes')}, objects added since then are left out of the manifest"
+    )
+metrics.write_summary(metrics_path(args.workspace_path, "CollectObjects"))
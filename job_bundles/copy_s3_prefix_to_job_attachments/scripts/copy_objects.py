@@ -1,25 +1,120 @@
 import argparse
 import json
+import os
 import sys
+import threading
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from urllib.parse import urlparse
 
 import boto3
+from boto3.s3.transfer import create_transfer_manager
 from botocore.exceptions import ClientError
 
+# This works because the "SharedLibrary" job environment sets PYTHONPATH.
+from copy_source import (
+    local_etag,
+    local_file_path,
+    open_unchanged_file,
+    parse_copy_source,
+)
+from metrics import Metrics, metrics_path
+from progress import OBJECT_LOG_MODES, ProgressReporter, object_log_path
+from s3_client import create_s3_client, transfer_config
+from shard_records import RecordFile, copy_list_path, count_records
+from task_journal import TaskJournal, journal_path
+from work_claims import claim_chunks, hold_claim, load_work_chunks, open_claims
+
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--index", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--existence-check",
+    choices=["head", "index"],
+    default="head",
+    help="Whether to check for each object in the job attachments bucket with s3:HeadObject, "
+    + "or by listing the parts of the job attachments Data prefix that the task needs up front.",
+)
+parser.add_argument(
+    "--index-prefix-length",
+    type=int,
+    default=2,
+    help="How many leading hex digits of the hash to partition the Data prefix listing by.",
+)
+parser.add_argument(
+    "--index-concurrency",
+    type=int,
+    default=32,
+    help="How many Data prefix partitions to list at the same time.",
+)
+parser.add_argument(
+    "--copy-concurrency",
+    type=int,
+    default=64,
+    help="How many objects to copy at the same time.",
+)
+parser.add_argument(
+    "--multipart-threshold",
+    type=int,
+    default=64 * 1024 * 1024,
+    help="Objects of at least this many bytes are copied, or uploaded from a local copy source, with multipart requests.",
+)
+parser.add_argument(
+    "--multipart-chunksize",
+    type=int,
+    default=64 * 1024 * 1024,
+    help="The part size in bytes for multipart copies and uploads.",
+)
+parser.add_argument(
+    "--multipart-concurrency",
+    type=int,
+    default=16,
+    help="How many parts to copy or upload at the same time, shared by all the multipart transfers.",
+)
+parser.add_argument(
+    "--max-megabytes-per-second",
+    type=float,
+    default=0,
+    help="The maximum rate to copy data at in MB/s, or 0 for no limit.",
+)
+parser.add_argument(
+    "--checkpoint-interval",
+    type=float,
+    default=10,
+    help="How many seconds apart to flush the journal of finished objects to disk, for a retried task to resume from.",
+)
+parser.add_argument(
+    "--object-log",
+    choices=OBJECT_LOG_MODES,
+    default="file",
+    help="Whether to write the log lines about each object to a compressed file in the workspace, "
+    + "print them, or drop them.",
+)
+parser.add_argument(
+    "--progress-interval",
+    type=float,
+    default=5,
+    help="How many seconds apart to report the progress.",
+)
 args = parser.parse_args()
 
 workspace_path = Path(sys.argv[1])
 
 session = boto3.Session()
-s3_client = session.client("s3")
+s3_client = create_s3_client(
+    session,
+    max(args.index_concurrency, args.copy_concurrency) + args.multipart_concurrency,
+)
+metrics = Metrics("CopyObjects")
+progress = ProgressReporter(
+    args.object_log,
+    object_log_path(workspace_path, "CopyObjects", args.index),
+    args.progress_interval,
+)
+metrics.instrument_client(s3_client)
 
-url = urlparse(args.copy_source, allow_fragments=False)
-s3_bucket_name = url.netloc
+s3_bucket_name, _ = parse_copy_source(args.copy_source)
 
 # Load the job attachments S3 settings
 with open(workspace_path / "job_attachment_settings.json") as fh:
@@ -27,43 +122,285 @@ with open(workspace_path / "job_attachment_settings.json") as fh:
 ja_s3_bucket_name = ja_settings["s3BucketName"]
 ja_root_prefix = ja_settings["rootPrefix"]
 
-# Load the list of objects this task will process
-with open(workspace_path / f"s3_objects_{args.index}.json") as fh:
-    s3_objects = json.load(fh)
 
-# Copy all the objects to the job attachments bucket
-print(f"openjd_status: Processing {len(s3_objects)} objects...")
+# For the "index" existence check, the hashes in each partition of the job attachments Data
+# prefix that this task listed, as 16-byte digests. A task that claims many chunks lists each
+# partition once, instead of once for every chunk that needs it.
+listed_data_partitions = {}
+
+
+def list_data_partition(hash_prefix):
+    """
+    Lists the job attachments Data prefix for hashes starting with hash_prefix, and
+    returns the set of their digests.
+    """
+    found_digests = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=ja_s3_bucket_name, Prefix=f"{ja_root_prefix}/Data/{hash_prefix}"
+    ):
+        for obj in page.get("Contents", []):
+            ja_hash, _, hash_alg = obj["Key"].rsplit("/", 1)[-1].partition(".")
+            if hash_alg == "xxh128":
+                try:
+                    found_digests.add(bytes.fromhex(ja_hash))
+                except ValueError:
+                    pass
+    return found_digests
+
+
+def load_existing_hashes(s3_objects):
+    """
+    For the "index" existence check, returns the set of hashes of s3_objects that are already in
+    the job attachments bucket. Only the hash prefixes that the objects need and that this task
+    hasn't listed for an earlier chunk get listed.
+    """
+    needed_hashes = {s3_object["xxh128_hash"] for s3_object in s3_objects}
+    hash_prefixes = sorted(
+        {h[: args.index_prefix_length] for h in needed_hashes}
+        - listed_data_partitions.keys()
+    )
+    if hash_prefixes:
+        print(
+            f"openjd_status: Listing {len(hash_prefixes)} partitions of the job attachments Data prefix..."
+        )
+        with ThreadPoolExecutor(max_workers=args.index_concurrency) as executor:
+            for hash_prefix, found_digests in zip(
+                hash_prefixes, executor.map(list_data_partition, hash_prefixes)
+            ):
+                listed_data_partitions[hash_prefix] = found_digests
+    existing_hashes = {
+        h
+        for h in needed_hashes
+        if bytes.fromhex(h) in listed_data_partitions[h[: args.index_prefix_length]]
+    }
+    print(
+        f"Found {len(existing_hashes)} of the hashes already in the job attachments bucket"
+    )
+    return existing_hashes
+
+
+class BandwidthLimiter:
+    """
+    Limits the average rate of bytes copied. Each copy waits until the bytes of the copies
+    before it fit within the rate, so the rate is bounded over the duration of the task.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_start_time = time.monotonic()
+
+    def consume(self, byte_count):
+        if self.bytes_per_second <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_start_time)
+            self._next_start_time = start_time + byte_count / self.bytes_per_second
+        time.sleep(max(0, start_time - now))
+
+
+bandwidth_limiter = BandwidthLimiter(args.max_megabytes_per_second * 1024 * 1024)
+# Large objects are handed to a transfer manager, which shares one pool of threads
+# for copying the parts across all of the multipart copies.
+transfer_manager = create_transfer_manager(
+    s3_client,
+    transfer_config(
+        args.multipart_concurrency,
+        multipart_threshold=args.multipart_threshold,
+        multipart_chunksize=args.multipart_chunksize,
+    ),
+)
+counter_lock = threading.Lock()
 copied_object_count = 0
 copied_bytes_count = 0
-for i, s3_object in enumerate(s3_objects):
-    print(f"openjd_progress: {100 * i / len(s3_objects):.1f}")
-    print(f"Processing key {s3_object['key']} with hash {s3_object['xxh128_hash']}")
-    ja_key = f"{ja_root_prefix}/Data/{s3_object['xxh128_hash']}.xxh128"
+# With the "index" existence check, the hashes of the current shard that are already in
+# the job attachments bucket
+existing_hashes = None
+
+
+def upload_local_file(s3_object, ja_key):
+    """
+    Uploads a file of a local copy source to the job attachments bucket. Files of at least
+    --multipart-threshold bytes are uploaded with parallel multipart PUTs.
+    """
+    path = local_file_path(s3_object["key"])
+    with open_unchanged_file(path, s3_object["etag"]) as fh:
+        if s3_object["size"] < args.multipart_threshold:
+            s3_client.put_object(Bucket=ja_s3_bucket_name, Key=ja_key, Body=fh)
+        else:
+            # Give the transfer manager the file name, so that it reads the parts
+            # concurrently as well as uploading them
+            transfer_manager.upload(
+                fileobj=path, bucket=ja_s3_bucket_name, key=ja_key
+            ).result()
+    # If the file changed during the upload, the data no longer matches its hash
+    if local_etag(os.stat(path)) != s3_object["etag"]:
+        s3_client.delete_object(Bucket=ja_s3_bucket_name, Key=ja_key)
+        raise ValueError(f"The file {path} changed while it was uploaded")
+
+
+def copy_s3_object(i, s3_object):
+    """
+    Copies the object to the job attachments bucket, unless it's already there. Returns
+    "copied" or "exists" for the journal.
+    """
+    global copied_object_count, copied_bytes_count
+    ja_hash = s3_object["xxh128_hash"]
+    progress.log_object(i, f"Processing key {s3_object['key']} with hash {ja_hash}")
+    ja_key = f"{ja_root_prefix}/Data/{ja_hash}.xxh128"
     # Check if the object exists, and skip the copy if it does
-    try:
-        s3_client.head_object(Bucket=ja_s3_bucket_name, Key=ja_key)
-        print("Skipping copy, it is already there")
-        continue
-    except ClientError as exc:
-        error_code = int(exc.response["ResponseMetadata"]["HTTPStatusCode"])
-        if error_code != 404:
-            raise
-    copied_object_count += 1
-    copied_bytes_count += s3_object["size"]
-    print(f"Copying {s3_object['size']} bytes...")
-    # Copy using the S3 managed copy operation that does a multi-threaded multi-part
-    # copy when applicable.
-    s3_client.copy(
-        CopySource={"Bucket": s3_bucket_name, "Key": s3_object["key"]},
-        Bucket=ja_s3_bucket_name,
-        Key=ja_key,
-        ExtraArgs={
+    if existing_hashes is not None:
+        # The index lists everything that existed when the shard started, so it
+        # is exact. At worst, an object another task just copied gets copied again.
+        if ja_hash in existing_hashes:
+            progress.log_object(i, "Skipping copy, it is already there")
+            return "exists"
+    else:
+        try:
+            s3_client.head_object(Bucket=ja_s3_bucket_name, Key=ja_key)
+            progress.log_object(i, "Skipping copy, it is already there")
+            return "exists"
+        except ClientError as exc:
+            error_code = int(exc.response["ResponseMetadata"]["HTTPStatusCode"])
+            if error_code != 404:
+                raise
+    bandwidth_limiter.consume(s3_object["size"])
+    if s3_bucket_name is None:
+        progress.log_object(i, f"Uploading {s3_object['size']} bytes...")
+        upload_local_file(s3_object, ja_key)
+    else:
+        progress.log_object(i, f"Copying {s3_object['size']} bytes...")
+        copy_source = {"Bucket": s3_bucket_name, "Key": s3_object["key"]}
+        extra_args = {
             "CopySourceIfMatch": s3_object["etag"],
             "MetadataDirective": "REPLACE",
             "TaggingDirective": "REPLACE",
-        },
+        }
+        if s3_object["size"] < args.multipart_threshold:
+            # Small objects take a single server-side CopyObject request
+            s3_client.copy_object(
+                CopySource=copy_source,
+                Bucket=ja_s3_bucket_name,
+                Key=ja_key,
+                **extra_args,
+            )
+        else:
+            # Use the S3 managed copy operation that does a multi-threaded multi-part copy
+            transfer_manager.copy(
+                copy_source=copy_source,
+                bucket=ja_s3_bucket_name,
+                key=ja_key,
+                extra_args=extra_args,
+            ).result()
+    with counter_lock:
+        copied_object_count += 1
+        copied_bytes_count += s3_object["size"]
+    metrics.add_progress(byte_count=s3_object["size"])
+    return "copied"
+
+
+def copy_shard(shard_index, executor):
+    """
+    Copies all the objects in the copy list of a shard to the job attachments bucket,
+    keeping a bounded number of them in flight. The finished objects are journaled, so
+    that a retry skips them.
+    """
+    global existing_hashes, processed_object_count
+    # Memory-map the list of objects to copy. DedupeObjects already removed the objects
+    # with duplicate hashes across all the shards.
+    s3_objects_path = copy_list_path(workspace_path, shard_index)
+    s3_objects = RecordFile(s3_objects_path)
+    journal = TaskJournal(
+        journal_path(workspace_path, "CopyObjects", shard_index),
+        s3_objects_path,
+        len(s3_objects),
+        args.checkpoint_interval,
+    )
+    if journal.shard_replaced:
+        # DedupeObjects ran again and wrote a new copy list since the journal was started
+        journal.reset()
+    if journal.completed_count:
+        print(
+            f"Resuming with {journal.completed_count} of the {len(s3_objects)} objects already processed"
+        )
+    if args.existence_check == "index":
+        existing_hashes = load_existing_hashes(s3_objects)
+    if work_chunks is None:
+        description = f"{len(s3_objects) - journal.completed_count} objects"
+    else:
+        description = f"{len(s3_objects) - journal.completed_count} objects of chunk {shard_index}"
+    print(
+        f"openjd_status: Processing {description} with {args.copy_concurrency} concurrent copies..."
+    )
+    progress.start(
+        f"Shard {shard_index}" if work_chunks is None else f"Chunk {shard_index}",
+        len(s3_objects),
+        journal.completed_count,
     )
+
+    def wait_for_completed(pending, return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            # Get the result so it re-raises any exceptions
+            status = future.result()
+            i, size = pending.pop(future)
+            journal.write(i, f"{status}\n".encode())
+            metrics.add_progress(objects=1)
+            progress.add(byte_count=size)
+
+    # Map each pending future to the index and size of its object
+    pending = {}
+    for i in range(len(s3_objects)):
+        if journal.completed[i]:
+            continue
+        if len(pending) >= 4 * args.copy_concurrency:
+            wait_for_completed(pending, FIRST_COMPLETED)
+        s3_object = s3_objects[i]
+        pending[executor.submit(copy_s3_object, i, s3_object)] = (
+            i,
+            s3_object["size"],
+        )
+    wait_for_completed(pending, ALL_COMPLETED)
+    journal.close()
+    processed_object_count += len(s3_objects)
+    s3_objects.close()
+
+
+# Copy the objects in the copy list for this task, or when CollectObjects split the objects
+# into more chunks than tasks, claim chunks until the tasks have claimed them all.
+work_chunks = load_work_chunks(workspace_path)
+claims = open_claims(work_chunks, workspace_path, s3_client, ja_s3_bucket_name)
+if work_chunks is None:
+    shard_indexes = [args.index]
+else:
+    shard_indexes = claim_chunks(claims, "CopyObjects", args.index, work_chunks)
+    # Report the progress against this task's share of the objects in all the chunks
+    chunk_object_count = sum(
+        count_records(copy_list_path(workspace_path, chunk))
+        for chunk in range(1, work_chunks["chunkCount"] + 1)
+    )
+    progress.expect(chunk_object_count // work_chunks["taskCount"])
+start_time = time.monotonic()
+processed_object_count = 0
+processed_shard_count = 0
+with ThreadPoolExecutor(max_workers=args.copy_concurrency) as executor:
+    for shard_index in shard_indexes:
+        with hold_claim(claims, "CopyObjects", shard_index, args.index):
+            copy_shard(shard_index, executor)
+        processed_shard_count += 1
+transfer_manager.shutdown()
+progress.close()
+if work_chunks is not None:
+    print(f"Claimed {processed_shard_count} of the {work_chunks['chunkCount']} chunks")
+elapsed_seconds = max(time.monotonic() - start_time, 1e-6)
+
+print(
+    f"Copy throughput: {copied_bytes_count / elapsed_seconds / 1024 / 1024:.2f}MB/s, {processed_object_count / elapsed_seconds:.1f} objects/s processed over {elapsed_seconds:.1f}s"
+)
+metrics.write_summary(metrics_path(workspace_path, "CopyObjects", args.index))
 print(
-    f"openjd_status: Processed {len(s3_objects)} objects (copied {copied_bytes_count} bytes in {copied_object_count} objects)"
+    f"openjd_status: Processed {processed_object_count} objects (copied {copied_bytes_count} bytes in {copied_object_count} objects)"
 )
 print("openjd_progress: 100")
@@ -0,0 +1,86 @@
+import argparse
+import sys
+from pathlib import Path
+
+# This works because the "SharedLibrary" job environment sets PYTHONPATH.
+from shard_records import (
+    RecordWriter,
+    copy_list_path,
+    iter_records,
+    shard_path,
+    uploaded_hashes_path,
+)
+from work_claims import shard_count
+
+parser = argparse.ArgumentParser(prog="dedupe_objects.py")
+parser.add_argument("workspace_path", type=Path)
+parser.add_argument("--parallelism", type=int, required=True)
+parser.add_argument(
+    "--passes",
+    type=int,
+    default=1,
+    help="How many passes over the shards to split the hash space into, to bound memory use.",
+)
+args = parser.parse_args()
+
+workspace_path = Path(sys.argv[1])
+# The number of shards is more than the parallelism when the tasks claim chunks
+shard_indexes = range(1, shard_count(workspace_path, args.parallelism) + 1)
+
+# Each pass handles the hashes whose leading 32 bits fall in one slice of the hash space,
+# so the set of hashes seen only needs to hold that slice.
+HASH_SPACE_SIZE = 2**32
+
+total_count = 0
+unique_count = 0
+total_size = 0
+unique_size = 0
+uploaded_count = 0
+copy_list_writers = [
+    RecordWriter(copy_list_path(workspace_path, index)) for index in shard_indexes
+]
+for pass_index in range(args.passes):
+    pass_start = pass_index * HASH_SPACE_SIZE // args.passes
+    pass_end = (pass_index + 1) * HASH_SPACE_SIZE // args.passes
+    # The first object found with each hash is the representative that gets copied,
+    # staying in the copy list of the shard it was originally assigned to.
+    seen_hashes = set()
+    # The hashes that HashObjects already uploaded, or found in the job attachments bucket,
+    # while hashing untagged objects. Objects with these hashes don't need copying.
+    uploaded_hashes = set()
+    for index in shard_indexes:
+        path = uploaded_hashes_path(workspace_path, index)
+        if path.exists():
+            with open(path) as fh:
+                for line in fh:
+                    ja_hash = line.strip()
+                    if pass_start <= int(ja_hash[:8], 16) < pass_end:
+                        uploaded_hashes.add(bytes.fromhex(ja_hash))
+    for index in shard_indexes:
+        for s3_object in iter_records(shard_path(workspace_path, index)):
+            ja_hash = s3_object["xxh128_hash"]
+            if not pass_start <= int(ja_hash[:8], 16) < pass_end:
+                continue
+            total_count += 1
+            total_size += s3_object["size"]
+            hash_bytes = bytes.fromhex(ja_hash)
+            if hash_bytes not in seen_hashes:
+                seen_hashes.add(hash_bytes)
+                unique_count += 1
+                unique_size += s3_object["size"]
+                if hash_bytes in uploaded_hashes:
+                    uploaded_count += 1
+                else:
+                    copy_list_writers[index - 1].write(s3_object)
+    print(
+        f"Pass {pass_index + 1} of {args.passes} found {len(seen_hashes)} unique hashes"
+    )
+    del seen_hashes, uploaded_hashes
+for writer in copy_list_writers:
+    writer.close()
+
+if uploaded_count:
+    print(f"{uploaded_count} unique hashes were already uploaded by HashObjects")
+print(
+    f"openjd_status: Found {unique_count} unique hashes among {total_count} objects, skipping {(total_size - unique_size) / 1024 / 1024:.2f}MB of duplicate data"
+)
@@ -1,32 +1,240 @@
 import argparse
+import asyncio
 import json
 import os
 import sys
+import threading
 from base64 import b64decode, b64encode
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from multiprocessing import get_context
 from pathlib import Path
-from urllib.parse import urlparse
+from uuid import uuid4
 
 import boto3
+from botocore.exceptions import ClientError
 from xxhash import xxh3_128
 
+# This works because the "SharedLibrary" job environment sets PYTHONPATH.
+from adaptive_concurrency import AdaptiveConcurrencyLimit
+from copy_source import hash_local_file, local_file_path, parse_copy_source
+from hash_cache import HashCache
+from manifest_writer import path_sort_key
+from metrics import Metrics, metrics_path
+from progress import OBJECT_LOG_MODES, ProgressReporter, object_log_path
+from s3_client import (
+    RETRY_MODE,
+    client_config_options,
+    create_s3_client,
+    transfer_config,
+)
+from shard_records import (
+    RecordFile,
+    RecordWriter,
+    count_records,
+    decode_record,
+    encode_record,
+    iter_records,
+    shard_path,
+    uploaded_hashes_path,
+    write_sorted_records,
+)
+from task_journal import TaskJournal, journal_path
+from work_claims import claim_chunks, hold_claim, load_work_chunks, open_claims
+
+# The object tag that holds the base64-encoded "<etag>|<xxh128-hash>" of an object
+HASH_TAG_KEY = "B64DeadlineJobAttachmentsXXH128"
+# The object tag that holds the base64-encoded "<version>|<etag>|<mtime>" of an object, with its
+# POSIX mtime in nanoseconds. It's separate from the hash tag so that versions of this job that
+# only know the hash tag can still read it.
+MTIME_TAG_KEY = "B64DeadlineJobAttachmentsMtime"
+MTIME_TAG_VERSION = "1"
+# S3 allows up to 10 tags on an object
+MAX_TAG_COUNT = 10
+# The largest object that a single CopyObject request can copy
+COPY_OBJECT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+# The smallest part of a multipart upload, other than the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--index", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--ranged-get-threshold",
+    type=int,
+    default=64 * 1024 * 1024,
+    help="Objects larger than this many bytes are downloaded with concurrent ranged GETs for hashing.",
+)
+parser.add_argument(
+    "--ranged-get-part-size",
+    type=int,
+    default=16 * 1024 * 1024,
+    help="The size in bytes of each ranged GET.",
+)
+parser.add_argument(
+    "--ranged-get-concurrency",
+    type=int,
+    default=8,
+    help="How many ranged GETs to run ahead of the hasher for each object.",
+)
+parser.add_argument(
+    "--prefetch-memory-limit",
+    type=int,
+    default=1024 * 1024 * 1024,
+    help="The maximum number of bytes of ranged GET parts to buffer across all objects.",
+)
+parser.add_argument(
+    "--engine",
+    choices=["threads", "asyncio"],
+    default="threads",
+    help="Whether to run the tag and metadata lookups on a thread pool or with asyncio.",
+)
+parser.add_argument(
+    "--async-max-in-flight",
+    type=int,
+    default=2000,
+    help="How many objects the asyncio engine processes at the same time.",
+)
+parser.add_argument(
+    "--hash-cache",
+    type=str,
+    default="",
+    help="The path of a SQLite hash cache to use, or empty to not use a cache.",
+)
+parser.add_argument(
+    "--hash-cache-max-entries",
+    type=int,
+    default=10_000_000,
+    help="The number of entries to keep in the hash cache, evicting the least recently used.",
+)
+parser.add_argument(
+    "--untagged-objects",
+    choices=["hash", "upload"],
+    default="hash",
+    help="Whether to only hash the objects that have no hash tag, leaving CopyObjects to copy them, "
+    + "or to upload them to the job attachments bucket while hashing them.",
+)
+parser.add_argument(
+    "--s3-inventory",
+    type=str,
+    default="",
+    help="The S3 Inventory that CollectObjects read the objects from, if any. Objects that were deleted "
+    + "or changed since the inventory report are then skipped and left out of the manifest.",
+)
+parser.add_argument(
+    "--min-concurrency",
+    type=int,
+    default=4,
+    help="The fewest objects the threads engine processes at the same time when S3 throttles requests.",
+)
+parser.add_argument(
+    "--max-concurrency",
+    type=int,
+    default=256,
+    help="The most objects the threads engine processes at the same time while S3 keeps up.",
+)
+parser.add_argument(
+    "--checkpoint-interval",
+    type=float,
+    default=10,
+    help="How many seconds apart to flush the journal of finished objects to disk, for a retried task to resume from.",
+)
+parser.add_argument(
+    "--object-log",
+    choices=OBJECT_LOG_MODES,
+    default="file",
+    help="Whether to write the log lines about each object to a compressed file in the workspace, "
+    + "print them, or drop them.",
+)
+parser.add_argument(
+    "--progress-interval",
+    type=float,
+    default=5,
+    help="How many seconds apart to report the progress.",
+)
 args = parser.parse_args()
 
+if args.untagged_objects == "upload" and args.ranged_get_part_size < MIN_PART_SIZE:
+    print(
+        f"openjd_fail: The ranged GET part size must be at least {MIN_PART_SIZE} bytes to upload untagged objects, since it's the multipart upload part size."
+    )
+    sys.exit(1)
+
+if args.engine == "asyncio":
+    try:
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+    except ImportError:
+        print(
+            "openjd_fail: The asyncio engine requires the aiobotocore package, add it to the CondaPackages job parameter."
+        )
+        sys.exit(1)
+
 workspace_path = Path(sys.argv[1])
 
+s3_bucket_name, _ = parse_copy_source(args.copy_source)
+
+# Get the available vcpus using the API recommended in Python documentation, then use 2 threads for each
+available_vcpus = len(os.sched_getaffinity(0))
+thread_count = 2 * available_vcpus
+# The files of a local copy source are hashed on a pool of processes, one for each vcpu. The pool
+# forks its processes, so start them before any threads start.
+process_pool = None
+if s3_bucket_name is None:
+    process_pool = ProcessPoolExecutor(
+        max_workers=available_vcpus, mp_context=get_context("fork")
+    )
+    process_pool.submit(os.getpid).result()
+# The threads engine starts from the thread count, and adapts how many objects it processes
+# at the same time to the S3 throttling and latency.
+concurrency_limit = AdaptiveConcurrencyLimit(
+    args.min_concurrency, args.max_concurrency, thread_count
+)
+# The ranged GET parts share a buffer budget across all the objects being hashed
+prefetch_part_count = max(1, args.prefetch_memory_limit // args.ranged_get_part_size)
+prefetch_part_slots = threading.BoundedSemaphore(prefetch_part_count)
+# Objects that take more than one buffer slot acquire them one at a time while holding this
+# lock, so that two of them can't each hold some of the slots while waiting for the rest.
+multiple_slots_lock = threading.Lock()
+ranged_get_executor = ThreadPoolExecutor(max_workers=prefetch_part_count)
+
 session = boto3.Session()
-s3_client = session.client("s3")
+# Every object in flight can have a request open, along with every ranged GET part. The
+# threads engine adapts its concurrency to the throttling in place of the retry rate limiter.
+s3_client = create_s3_client(
+    session,
+    max(thread_count, concurrency_limit.max_limit) + prefetch_part_count,
+    retry_mode="standard" if args.engine == "threads" else RETRY_MODE,
+)
+metrics = Metrics("HashObjects")
+progress = ProgressReporter(
+    args.object_log,
+    object_log_path(workspace_path, "HashObjects", args.index),
+    args.progress_interval,
+)
+metrics.instrument_client(s3_client)
+concurrency_limit.instrument_client(s3_client)
+
+# Load the job attachments S3 settings
+with open(workspace_path / "job_attachment_settings.json") as fh:
+    ja_settings = json.load(fh)
+ja_s3_bucket_name = ja_settings["s3BucketName"]
+ja_root_prefix = ja_settings["rootPrefix"]
 
-url = urlparse(args.copy_source, allow_fragments=False)
-s3_bucket_name = url.netloc
 
-# Load the list of objects this task will process
-with open(workspace_path / f"s3_objects_{args.index}.json") as fh:
-    s3_objects = json.load(fh)
+def set_mtime(s3_object, mtime):
+    """Sets the 'mtime' entry in s3_object to the POSIX mtime of the object."""
+    if mtime != s3_object["mtime"]:
+        # Keep the listed mtime for comparing against the listing of an incremental snapshot
+        s3_object.setdefault("listed_mtime", s3_object["mtime"])
+        s3_object["mtime"] = mtime
 
 
 def update_mtime_from_metadata(s3_object, metadata):
@@ -35,100 +243,759 @@ def update_mtime_from_metadata(s3_object, metadata):
         # DataSync, FSx for Lustre, among others use x-amz-meta-file-mtime,
         # which is nanoseconds if it has an "ns" suffix, otherwise milliseconds.
         if posix_mtime_metadata[-2:] == "ns":
-            s3_object["mtime"] = int(posix_mtime_metadata[:-2])
+            set_mtime(s3_object, int(posix_mtime_metadata[:-2]))
         else:
-            s3_object["mtime"] = int(float(posix_mtime_metadata) * 1e6)
+            set_mtime(s3_object, int(float(posix_mtime_metadata) * 1e6))
     elif posix_mtime_metadata := metadata.get("mtime"):
         # S3FS, RClone, among others use x-amz-meta-mtime, which is seconds
         # and may be floating point
-        s3_object["mtime"] = int(float(posix_mtime_metadata) * 1e9)
+        set_mtime(s3_object, int(float(posix_mtime_metadata) * 1e9))
 
 
 # Check all the objects for the hash tag, and hash the data if it's missing or doesn't match the etag
 hashed_object_count = 0
 hashed_bytes_count = 0
+counter_lock = threading.Lock()
+uploaded_object_count = 0
+uploaded_bytes_count = 0
+# The file that the hashes of the current shard that are in the job attachments bucket after
+# uploading untagged objects are appended to
+uploaded_hashes_fh = None
 
 
-def process_s3_object(i, s3_object):
-    # NOTE: If we don't combine "\n" inside the main string of print(), it interleaves the "\n" with
-    #       the bodies, and some lines get doubled up while others are empty.
-    print(f"{i}: Processing key {s3_object['key']}\n", end="")
-    response = s3_client.get_object_tagging(Bucket=s3_bucket_name, Key=s3_object["key"])
-    tag_set = response["TagSet"]
+def acquire_buffer_slots(byte_count):
+    """Waits for enough buffer slots to hold byte_count bytes, returning how many it acquired."""
+    slot_count = min(
+        prefetch_part_count, max(1, -(-byte_count // args.ranged_get_part_size))
+    )
+    with multiple_slots_lock:
+        for _ in range(slot_count):
+            prefetch_part_slots.acquire()
+    return slot_count
+
+
+def release_buffer_slots(slot_count):
+    for _ in range(slot_count):
+        prefetch_part_slots.release()
+
+
+def get_object_range(s3_object, start, end):
+    """Downloads bytes start through end inclusive of the object, returning (data, metadata)."""
+    response = s3_client.get_object(
+        Bucket=s3_bucket_name,
+        Key=s3_object["key"],
+        Range=f"bytes={start}-{end}",
+        IfMatch=s3_object["etag"],
+    )
+    return response["Body"].read(), response["Metadata"]
+
+
+def upload_part(upload, part_number, data):
+    """Uploads one part of a multipart upload, returning the part for completing it."""
+    response = s3_client.upload_part(
+        Bucket=ja_s3_bucket_name,
+        Key=upload["Key"],
+        UploadId=upload["UploadId"],
+        PartNumber=part_number,
+        Body=data,
+    )
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+def hash_object_with_ranged_gets(s3_object, hasher, upload=None):
+    """
+    Feeds the object data to the hasher in order, while running ranged GETs for the parts
+    that follow concurrently. The parts waiting to be hashed form a bounded reorder buffer,
+    limited per object by --ranged-get-concurrency and across all objects by
+    --prefetch-memory-limit. Returns the object metadata.
+
+    If upload is a multipart upload, each part is also uploaded as it's hashed, and
+    upload["Parts"] is set to the list of uploaded parts.
+    """
+    size = s3_object["size"]
+    part_size = args.ranged_get_part_size
+    part_count = (size + part_size - 1) // part_size
+    next_part = 0
+    in_flight = deque()
+    part_uploads = []
+    metadata = None
+    try:
+        while next_part < part_count or in_flight:
+            while (
+                next_part < part_count and len(in_flight) < args.ranged_get_concurrency
+            ):
+                # Only wait for a buffer slot when this object has no parts in flight,
+                # otherwise objects holding slots could wait on each other forever.
+                if not prefetch_part_slots.acquire(blocking=not in_flight):
+                    break
+                start = next_part * part_size
+                end = min(start + part_size, size) - 1
+                in_flight.append(
+                    ranged_get_executor.submit(get_object_range, s3_object, start, end)
+                )
+                next_part += 1
+            data, part_metadata = in_flight.popleft().result()
+            with metrics.timer("HashData"):
+                hasher.update(data)
+            if upload is None:
+                prefetch_part_slots.release()
+            else:
+                # The part keeps its buffer slot until it's uploaded
+                part_upload = ranged_get_executor.submit(
+                    upload_part, upload, len(part_uploads) + 1, data
+                )
+                part_upload.add_done_callback(lambda _: prefetch_part_slots.release())
+                part_uploads.append(part_upload)
+            if metadata is None:
+                metadata = part_metadata
+        if upload is not None:
+            upload["Parts"] = [part_upload.result() for part_upload in part_uploads]
+    finally:
+        # If hashing failed part way, release the buffer slots as the remaining parts finish
+        for future in in_flight:
+            future.add_done_callback(lambda _: prefetch_part_slots.release())
+    return metadata
+
+
+def get_tagged_hash(s3_object, tag_set):
+    """Returns the hash from the object tags if they have one for the listed etag, otherwise None."""
     tag_set_dict = {obj["Key"]: obj["Value"] for obj in tag_set}
-    etag_and_hash_encoded = tag_set_dict.get("B64DeadlineJobAttachmentsXXH128")
+    etag_and_hash_encoded = tag_set_dict.get(HASH_TAG_KEY)
     if etag_and_hash_encoded:
         etag, ja_hash = (
             b64decode(etag_and_hash_encoded.encode("ascii")).decode("utf-8").split("|")
         )
         if etag == s3_object["etag"]:
-            # If it's tagged, and the etag matches, use the JA hash from the tag
-            s3_object["xxh128_hash"] = ja_hash
-            print(f"{i}: Using the tagged hash {ja_hash}\n", end="")
-            # Get the POSIX mtime if it's set
+            return ja_hash
+    return None
+
+
+def get_tagged_mtime(s3_object, tag_set):
+    """
+    Returns the POSIX mtime from the object tags if they have one for the listed etag in
+    a version of the tag format this script knows, otherwise None.
+    """
+    tag_set_dict = {obj["Key"]: obj["Value"] for obj in tag_set}
+    mtime_encoded = tag_set_dict.get(MTIME_TAG_KEY)
+    if mtime_encoded:
+        # Check the version before splitting the rest, as other versions can have other fields
+        version, _, fields = (
+            b64decode(mtime_encoded.encode("ascii")).decode("utf-8").partition("|")
+        )
+        if version == MTIME_TAG_VERSION:
+            etag, mtime = fields.split("|")
+            if etag == s3_object["etag"]:
+                return int(mtime)
+    return None
+
+
+def job_attachments_tag_set(s3_object, tag_set):
+    """
+    Returns the object's tag_set with the hash and mtime tags of s3_object replacing any it
+    had. The mtime tag is left out if the object already has the most tags S3 allows.
+    """
+    etag_and_hash = f"{s3_object['etag']}|{s3_object['xxh128_hash']}"
+    mtime = f"{MTIME_TAG_VERSION}|{s3_object['etag']}|{s3_object['mtime']}"
+    tag_set = [
+        obj for obj in tag_set if obj["Key"] not in (HASH_TAG_KEY, MTIME_TAG_KEY)
+    ]
+    tag_set.append(
+        {"Key": HASH_TAG_KEY, "Value": b64encode(etag_and_hash.encode()).decode()}
+    )
+    if len(tag_set) < MAX_TAG_COUNT:
+        tag_set.append(
+            {"Key": MTIME_TAG_KEY, "Value": b64encode(mtime.encode()).decode()}
+        )
+    return tag_set
+
+
+def upgraded_tag_set(s3_object, tag_set):
+    """
+    Returns the tag set to upgrade tags that only have the hash to, adding the mtime tag,
+    or None if there's no room for it.
+    """
+    tag_set = job_attachments_tag_set(s3_object, tag_set)
+    if any(obj["Key"] == MTIME_TAG_KEY for obj in tag_set):
+        return tag_set
+    return None
+
+
+# The files of a local copy source have no bucket in the hash cache
+hash_cache_bucket_name = s3_bucket_name or ""
+
+
+def use_cached_hash(i, s3_object):
+    """If the hash cache has the object, updates s3_object from it and returns True."""
+    if hash_cache is None:
+        return False
+    cached = hash_cache.get(hash_cache_bucket_name, s3_object["key"], s3_object["etag"])
+    if cached is None:
+        return False
+    listed_mtime = s3_object["mtime"]
+    s3_object["xxh128_hash"], s3_object["mtime"] = cached
+    if s3_object["mtime"] != listed_mtime:
+        s3_object["listed_mtime"] = listed_mtime
+    progress.log_object(i, f"Using the cached hash {s3_object['xxh128_hash']}")
+    return True
+
+
+def save_to_hash_cache(s3_object):
+    """Saves the hash and mtime of s3_object to the hash cache, if there is one."""
+    if hash_cache is not None:
+        hash_cache.put(
+            hash_cache_bucket_name,
+            s3_object["key"],
+            s3_object["etag"],
+            s3_object["xxh128_hash"],
+            s3_object["mtime"],
+        )
+
+
+def process_s3_object(i, s3_object):
+    """Gets the hash and POSIX mtime of the object, and returns the updated s3_object."""
+    progress.log_object(i, f"Processing key {s3_object['key']}")
+    if use_cached_hash(i, s3_object):
+        if args.s3_inventory:
+            # Make sure the object wasn't deleted or changed since the inventory report
+            s3_client.head_object(
+                Bucket=s3_bucket_name, Key=s3_object["key"], IfMatch=s3_object["etag"]
+            )
+        return s3_object
+    response = s3_client.get_object_tagging(Bucket=s3_bucket_name, Key=s3_object["key"])
+    tag_set = response["TagSet"]
+    if ja_hash := get_tagged_hash(s3_object, tag_set):
+        # If it's tagged, and the etag matches, use the JA hash from the tag
+        s3_object["xxh128_hash"] = ja_hash
+        progress.log_object(i, f"Using the tagged hash {ja_hash}")
+        if (tagged_mtime := get_tagged_mtime(s3_object, tag_set)) is not None:
+            # The tags have the POSIX mtime as well, so no more requests are needed
+            set_mtime(s3_object, tagged_mtime)
+        else:
+            # Get the POSIX mtime if it's set, and add it to the tags for the next time
             response = s3_client.head_object(
                 Bucket=s3_bucket_name, Key=s3_object["key"]
             )
             update_mtime_from_metadata(s3_object, response["Metadata"])
-            return
+            if new_tag_set := upgraded_tag_set(s3_object, tag_set):
+                s3_client.put_object_tagging(
+                    Bucket=s3_bucket_name,
+                    Key=s3_object["key"],
+                    Tagging={"TagSet": new_tag_set},
+                )
+        save_to_hash_cache(s3_object)
+        return s3_object
+
+    return hash_s3_object(i, s3_object, tag_set)
+
+
+async def process_s3_object_async(i, s3_object, async_s3_client, executor):
+    """
+    The asyncio version of process_s3_object. Objects that need hashing are handed off
+    to the thread pool executor, as that is bound by bandwidth and CPU instead of latency.
+    The hash cache calls go to their own thread, so that SQLite waiting on the disk or on
+    other processes doesn't hold up the requests in flight.
+    """
+    progress.log_object(i, f"Processing key {s3_object['key']}")
+    loop = asyncio.get_running_loop()
+    if hash_cache is not None and await loop.run_in_executor(
+        hash_cache_executor, use_cached_hash, i, s3_object
+    ):
+        if args.s3_inventory:
+            # Make sure the object wasn't deleted or changed since the inventory report
+            await async_s3_client.head_object(
+                Bucket=s3_bucket_name, Key=s3_object["key"], IfMatch=s3_object["etag"]
+            )
+        return s3_object
+    response = await async_s3_client.get_object_tagging(
+        Bucket=s3_bucket_name, Key=s3_object["key"]
+    )
+    tag_set = response["TagSet"]
+    if ja_hash := get_tagged_hash(s3_object, tag_set):
+        # If it's tagged, and the etag matches, use the JA hash from the tag
+        s3_object["xxh128_hash"] = ja_hash
+        progress.log_object(i, f"Using the tagged hash {ja_hash}")
+        if (tagged_mtime := get_tagged_mtime(s3_object, tag_set)) is not None:
+            # The tags have the POSIX mtime as well, so no more requests are needed
+            set_mtime(s3_object, tagged_mtime)
+        else:
+            # Get the POSIX mtime if it's set, and add it to the tags for the next time
+            response = await async_s3_client.head_object(
+                Bucket=s3_bucket_name, Key=s3_object["key"]
+            )
+            update_mtime_from_metadata(s3_object, response["Metadata"])
+            if new_tag_set := upgraded_tag_set(s3_object, tag_set):
+                await async_s3_client.put_object_tagging(
+                    Bucket=s3_bucket_name,
+                    Key=s3_object["key"],
+                    Tagging={"TagSet": new_tag_set},
+                )
+        if hash_cache is not None:
+            await loop.run_in_executor(
+                hash_cache_executor, save_to_hash_cache, s3_object
+            )
+        return s3_object
+
+    return await loop.run_in_executor(executor, hash_s3_object, i, s3_object, tag_set)
+
+
+def is_in_ja_bucket(ja_key):
+    """Returns whether the object ja_key is already in the job attachments bucket."""
+    try:
+        s3_client.head_object(Bucket=ja_s3_bucket_name, Key=ja_key)
+        return True
+    except ClientError as exc:
+        error_code = int(exc.response["ResponseMetadata"]["HTTPStatusCode"])
+        if error_code != 404:
+            raise
+        return False
 
-    # We don't know the hash, so we need to compute it
+
+def record_uploaded(s3_object, uploaded):
+    """Records that the object's hash is in the job attachments bucket, and whether this task uploaded it."""
+    global uploaded_object_count, uploaded_bytes_count
+    with counter_lock:
+        uploaded_hashes_fh.write(f"{s3_object['xxh128_hash']}\n")
+        if uploaded:
+            uploaded_object_count += 1
+            uploaded_bytes_count += s3_object["size"]
+
+
+def hash_and_upload_small_object(i, s3_object, hasher):
+    """
+    Downloads the object into memory to hash it, then uploads it to the job attachments
+    bucket unless it's already there. The data takes buffer slots from the
+    --prefetch-memory-limit until it's uploaded. Returns a tuple (metadata, uploaded).
+    """
+    slot_count = acquire_buffer_slots(s3_object["size"])
+    try:
+        response = s3_client.get_object(
+            Bucket=s3_bucket_name, Key=s3_object["key"], IfMatch=s3_object["etag"]
+        )
+        data = response["Body"].read()
+        with metrics.timer("HashData"):
+            hasher.update(data)
+        ja_key = f"{ja_root_prefix}/Data/{hasher.hexdigest()}.xxh128"
+        if is_in_ja_bucket(ja_key):
+            progress.log_object(i, "Skipping upload, it is already there")
+            uploaded = False
+        else:
+            progress.log_object(i, f"Uploading {len(data)} bytes...")
+            s3_client.put_object(Bucket=ja_s3_bucket_name, Key=ja_key, Body=data)
+            uploaded = True
+    finally:
+        release_buffer_slots(slot_count)
+    return response["Metadata"], uploaded
+
+
+def hash_and_upload_large_object(i, s3_object, hasher):
+    """
+    Uploads the object to a temporary key in the job attachments bucket with a multipart upload,
+    while hashing it with ranged GETs. Once the hash is known, the upload is either promoted
+    to the hash's Data key with a server-side copy, or aborted if that key already exists.
+    Returns a tuple (metadata, uploaded).
+    """
+    upload_key = f"{ja_root_prefix}/Uploads/{uuid4().hex}"
+    response = s3_client.create_multipart_upload(
+        Bucket=ja_s3_bucket_name, Key=upload_key
+    )
+    upload = {"Key": upload_key, "UploadId": response["UploadId"]}
+    try:
+        metadata = hash_object_with_ranged_gets(s3_object, hasher, upload)
+    except BaseException:
+        s3_client.abort_multipart_upload(
+            Bucket=ja_s3_bucket_name, Key=upload_key, UploadId=upload["UploadId"]
+        )
+        raise
+    ja_key = f"{ja_root_prefix}/Data/{hasher.hexdigest()}.xxh128"
+    if is_in_ja_bucket(ja_key):
+        progress.log_object(i, "Discarding upload, it is already there")
+        s3_client.abort_multipart_upload(
+            Bucket=ja_s3_bucket_name, Key=upload_key, UploadId=upload["UploadId"]
+        )
+        return metadata, False
+    s3_client.complete_multipart_upload(
+        Bucket=ja_s3_bucket_name,
+        Key=upload_key,
+        UploadId=upload["UploadId"],
+        MultipartUpload={"Parts": upload["Parts"]},
+    )
+    try:
+        progress.log_object(i, f"Promoting the upload to {ja_key}")
+        copy_source = {"Bucket": ja_s3_bucket_name, "Key": upload_key}
+        if s3_object["size"] <= COPY_OBJECT_MAX_SIZE:
+            s3_client.copy_object(
+                CopySource=copy_source,
+                Bucket=ja_s3_bucket_name,
+                Key=ja_key,
+                MetadataDirective="REPLACE",
+            )
+        else:
+            # Objects over the CopyObject limit take a managed multipart copy
+            s3_client.copy(
+                copy_source,
+                ja_s3_bucket_name,
+                ja_key,
+                ExtraArgs={"MetadataDirective": "REPLACE"},
+                Config=transfer_config(
+                    args.ranged_get_concurrency,
+                    multipart_threshold=COPY_OBJECT_MAX_SIZE,
+                    multipart_chunksize=args.ranged_get_part_size,
+                ),
+            )
+    finally:
+        s3_client.delete_object(Bucket=ja_s3_bucket_name, Key=upload_key)
+    return metadata, True
+
+
+def hash_s3_object(i, s3_object, tag_set):
+    """
+    Computes the hash of the object data and saves it in the object tags, given the
+    object's current tag_set. Returns the updated s3_object.
+    """
     global hashed_object_count, hashed_bytes_count
-    hashed_object_count += 1
-    hashed_bytes_count += s3_object["size"]
     hasher = xxh3_128()
-    if s3_object["size"] > 0:
+    # Whether this task uploaded the object to the job attachments bucket, if it tried to.
+    # Objects that need more parts than the multipart upload limit of 10000 are only
+    # hashed, and left for CopyObjects to copy.
+    uploaded = None
+    upload_untagged = args.untagged_objects == "upload"
+    size = s3_object["size"]
+    if upload_untagged and 0 < size <= args.ranged_get_threshold:
+        metadata, uploaded = hash_and_upload_small_object(i, s3_object, hasher)
+        update_mtime_from_metadata(s3_object, metadata)
+    elif (
+        upload_untagged
+        and args.ranged_get_threshold < size <= 10000 * args.ranged_get_part_size
+    ):
+        metadata, uploaded = hash_and_upload_large_object(i, s3_object, hasher)
+        update_mtime_from_metadata(s3_object, metadata)
+    elif size > args.ranged_get_threshold:
+        metadata = hash_object_with_ranged_gets(s3_object, hasher)
+        update_mtime_from_metadata(s3_object, metadata)
+    elif size > 0:
         response = s3_client.get_object(
             Bucket=s3_bucket_name, Key=s3_object["key"], IfMatch=s3_object["etag"]
         )
         update_mtime_from_metadata(s3_object, response["Metadata"])
         for chunk in response["Body"].iter_chunks(2**20):
-            hasher.update(chunk)
+            with metrics.timer("HashData"):
+                hasher.update(chunk)
     else:
         # Get the POSIX mtime if it's set
         response = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_object["key"])
         update_mtime_from_metadata(s3_object, response["Metadata"])
     ja_hash = hasher.hexdigest()
     s3_object["xxh128_hash"] = ja_hash
-    print(f"{i}: Calculated hash {ja_hash}\n", end="")
+    progress.log_object(i, f"Calculated hash {ja_hash}")
+    metrics.add_progress(byte_count=size)
+    with counter_lock:
+        hashed_object_count += 1
+        hashed_bytes_count += size
+    if uploaded is not None:
+        record_uploaded(s3_object, uploaded)
 
-    # Save the hash as an object tag
-    etag_and_hash = b64encode(f"{s3_object['etag']}|{ja_hash}".encode("utf-8")).decode(
-        "ascii"
-    )
-    tag_set = [
-        obj for obj in tag_set if obj["Key"] != "B64DeadlineJobAttachmentsXXH128"
-    ]
-    tag_set.append({"Key": "B64DeadlineJobAttachmentsXXH128", "Value": etag_and_hash})
+    # Save the hash and mtime as object tags
     s3_client.put_object_tagging(
         Bucket=s3_bucket_name,
         Key=s3_object["key"],
-        Tagging={"TagSet": tag_set},
+        Tagging={"TagSet": job_attachments_tag_set(s3_object, tag_set)},
     )
+    save_to_hash_cache(s3_object)
+    return s3_object
 
 
-# Get the available vcpus using the API recommended in Python documentation, then use 2 threads for each
-available_vcpus = len(os.sched_getaffinity(0))
-thread_count = 2 * available_vcpus
-# Use multithreaded scheduling, as the xxhash function always releases the GIL
-print(
-    f"openjd_status: Processing {len(s3_objects)} objects using {thread_count} threads..."
+s3_object_count = 0
+s3_objects_path = None
+# The journal of the finished objects of the current shard
+journal = None
+# The journal payload of an object that was skipped, which is left out of the updated shard
+SKIPPED_PAYLOAD = b"\n"
+# How many objects from an S3 Inventory were skipped, because they were deleted or changed
+# since the inventory report
+skipped_object_count = 0
+
+
+def is_missing_object_error(exc):
+    """
+    Returns whether the exception is from S3 not finding the object, or finding that its etag
+    no longer matches the listed etag.
+    """
+    return isinstance(exc, ClientError) and exc.response["ResponseMetadata"][
+        "HTTPStatusCode"
+    ] in (404, 412)
+
+
+def write_completed_object(i, s3_object):
+    """Writes an updated object to the journal, and reports progress."""
+    journal.write(i, encode_record(s3_object))
+    metrics.add_progress(objects=1)
+    progress.add(byte_count=s3_object["size"])
+
+
+def write_completed(done, pending_indexes):
+    """
+    Writes the updated objects from the done futures to the journal, and reports progress.
+    The pending_indexes map each pending future to the index of its object in the shard.
+    With an S3 Inventory, objects that were deleted or changed since the report are
+    journaled as skipped instead of failing the task.
+    """
+    global skipped_object_count
+    for future in done:
+        i = pending_indexes.pop(future)
+        try:
+            # Get the result so it re-raises any exceptions
+            s3_object = future.result()
+        except ClientError as exc:
+            if not (args.s3_inventory and is_missing_object_error(exc)):
+                raise
+            with RecordFile(s3_objects_path) as records:
+                key = records[i]["key"]
+            print(
+                f"Skipping {key}, it was deleted or changed since the S3 Inventory report: {exc}"
+            )
+            skipped_object_count += 1
+            journal.write(i, SKIPPED_PAYLOAD)
+            metrics.add_progress(objects=1)
+            progress.add()
+            continue
+        write_completed_object(i, s3_object)
+
+
+def iter_unfinished_objects(s3_objects_path):
+    """Yields (i, s3_object) for the objects of the shard that aren't in the journal yet."""
+    for i, s3_object in enumerate(iter_records(s3_objects_path)):
+        if not journal.completed[i]:
+            yield i, s3_object
+
+
+def process_s3_object_in_slot(i, s3_object):
+    """Processes the object, then releases its slot under the adaptive concurrency limit."""
+    try:
+        return process_s3_object(i, s3_object)
+    finally:
+        concurrency_limit.release()
+
+
+def process_with_threads(executor, s3_objects_path):
+    """
+    Processes the unfinished objects of the shard, keeping as many of them in flight on the
+    executor as the adaptive concurrency limit allows.
+    """
+    pending = {}
+    for i, s3_object in iter_unfinished_objects(s3_objects_path):
+        while not concurrency_limit.try_acquire():
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            write_completed(done, pending)
+        pending[executor.submit(process_s3_object_in_slot, i, s3_object)] = i
+    write_completed(wait(pending).done, pending)
+
+
+async def process_with_asyncio(executor, s3_objects_path):
+    """Processes the unfinished objects of the shard, keeping up to --async-max-in-flight of them in flight."""
+    config = AioConfig(**client_config_options(args.async_max_in_flight))
+    async with get_session().create_client("s3", config=config) as async_s3_client:
+        metrics.instrument_client(async_s3_client)
+        pending = {}
+        for i, s3_object in iter_unfinished_objects(s3_objects_path):
+            if len(pending) >= args.async_max_in_flight:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                write_completed(done, pending)
+            future = asyncio.ensure_future(
+                process_s3_object_async(i, s3_object, async_s3_client, executor)
+            )
+            pending[future] = i
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            write_completed(done, pending)
+
+
+def process_local_files(s3_objects_path):
+    """
+    Hashes all the files of the shard from a local copy source on the process pool, keeping
+    a bounded number of them in flight.
+    """
+    pending = {}
+
+    def write_hashed(return_when):
+        global hashed_object_count, hashed_bytes_count
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            i, s3_object = pending.pop(future)
+            s3_object["xxh128_hash"] = future.result()
+            progress.log_object(i, f"Calculated hash {s3_object['xxh128_hash']}")
+            with counter_lock:
+                hashed_object_count += 1
+                hashed_bytes_count += s3_object["size"]
+            metrics.add_progress(byte_count=s3_object["size"])
+            save_to_hash_cache(s3_object)
+            write_completed_object(i, s3_object)
+
+    for i, s3_object in iter_unfinished_objects(s3_objects_path):
+        path = local_file_path(s3_object["key"])
+        progress.log_object(i, f"Processing file {path}")
+        if use_cached_hash(i, s3_object):
+            write_completed_object(i, s3_object)
+            continue
+        if len(pending) >= 4 * available_vcpus:
+            write_hashed(FIRST_COMPLETED)
+        future = process_pool.submit(hash_local_file, path, s3_object["etag"])
+        pending[future] = (i, s3_object)
+    write_hashed(ALL_COMPLETED)
+
+
+def open_uploaded_hashes(shard_index, resume):
+    """
+    Opens the file of the hashes that are now in the job attachments bucket for the shard, so
+    DedupeObjects can leave them out of the CopyObjects lists. When resuming, this appends to
+    the hashes saved before, without any partial line that the interruption left.
+    """
+    path = uploaded_hashes_path(workspace_path, shard_index)
+    saved_hashes = ""
+    if resume and path.exists():
+        saved_hashes = path.read_text()
+        saved_hashes = saved_hashes[: saved_hashes.rfind("\n") + 1]
+    # Line buffering writes each hash through before the journal records its object
+    fh = open(path, "w", buffering=1)
+    fh.write(saved_hashes)
+    return fh
+
+
+def process_shard(shard_index, executor):
+    """
+    Processes all the objects of a shard, and replaces the shard with the updated objects
+    sorted in manifest order, so that SaveManifest can merge the shards as a stream. The
+    updated objects are journaled as they finish, so that a retry resumes from the journal.
+    """
+    global s3_object_count, s3_objects_path, journal, uploaded_hashes_fh
+    s3_objects_path = shard_path(workspace_path, shard_index)
+    s3_object_count = count_records(s3_objects_path)
+    journal = TaskJournal(
+        journal_path(workspace_path, "HashObjects", shard_index),
+        s3_objects_path,
+        s3_object_count,
+        args.checkpoint_interval,
+    )
+    if journal.shard_replaced:
+        # A previous attempt of this task finished the shard, and failed after
+        print(f"openjd_status: Shard {shard_index} was already processed")
+        return
+    completed_count = journal.completed_count
+    if completed_count:
+        print(
+            f"Resuming with {completed_count} of the {s3_object_count} objects already processed"
+        )
+    if work_chunks is None:
+        description = f"{s3_object_count - completed_count} objects"
+    else:
+        description = (
+            f"{s3_object_count - completed_count} objects of chunk {shard_index}"
+        )
+    if s3_bucket_name is None:
+        print(
+            f"openjd_status: Processing {description} using {available_vcpus} processes for hashing..."
+        )
+    elif args.engine == "asyncio":
+        print(
+            f"openjd_status: Processing {description} using asyncio with up to {args.async_max_in_flight} in flight, and {thread_count} threads for hashing..."
+        )
+    else:
+        # Use multithreaded scheduling, as the xxhash function always releases the GIL
+        print(
+            f"openjd_status: Processing {description} using {int(concurrency_limit.limit)} threads, adapting between {concurrency_limit.min_limit} and {concurrency_limit.max_limit}..."
+        )
+
+    progress.start(
+        f"Shard {shard_index}" if work_chunks is None else f"Chunk {shard_index}",
+        s3_object_count,
+        completed_count,
+    )
+    if args.untagged_objects == "upload":
+        uploaded_hashes_fh = open_uploaded_hashes(shard_index, completed_count > 0)
+    # Stream the unfinished objects from the shard into the journal
+    if s3_bucket_name is None:
+        process_local_files(s3_objects_path)
+    elif args.engine == "asyncio":
+        asyncio.run(process_with_asyncio(executor, s3_objects_path))
+    else:
+        process_with_threads(executor, s3_objects_path)
+    if uploaded_hashes_fh is not None:
+        uploaded_hashes_fh.close()
+        uploaded_hashes_fh = None
+
+    # Write the updated objects from the journal to a new shard file that replaces the original
+    updated_s3_objects_path = s3_objects_path.with_suffix(".hashed.jsonl")
+    with RecordWriter(updated_s3_objects_path) as writer:
+        for payload in journal.iter_payloads():
+            if payload != SKIPPED_PAYLOAD:
+                writer.write(decode_record(payload))
+    write_sorted_records(
+        updated_s3_objects_path,
+        s3_objects_path,
+        lambda s3_object: path_sort_key(s3_object["key"]),
+    )
+    journal.finish()
+
+
+# Open the hash cache if it's enabled
+hash_cache = None
+if args.hash_cache:
+    hash_cache_path = Path(args.hash_cache).expanduser()
+    hash_cache = HashCache(hash_cache_path, args.hash_cache_max_entries)
+    print(f"Using the hash cache {hash_cache_path}")
+# The asyncio engine makes its hash cache calls on this thread, as the cache serializes them
+hash_cache_executor = ThreadPoolExecutor(max_workers=1)
+
+# Process the shard for this task, or when CollectObjects split the objects into more chunks
+# than tasks, claim chunks until the tasks have claimed them all.
+work_chunks = load_work_chunks(workspace_path)
+claims = open_claims(work_chunks, workspace_path, s3_client, ja_s3_bucket_name)
+if work_chunks is None:
+    shard_indexes = [args.index]
+else:
+    shard_indexes = claim_chunks(claims, "HashObjects", args.index, work_chunks)
+    # Report the progress against this task's share of the objects in all the chunks
+    with open(workspace_path / "shard_costs.json") as fh:
+        chunk_object_count = sum(
+            shard["objectCount"] for shard in json.load(fh)["shards"]
+        )
+    progress.expect(chunk_object_count // work_chunks["taskCount"])
+processed_object_count = 0
+processed_shard_count = 0
+executor_thread_count = (
+    thread_count if args.engine == "asyncio" else concurrency_limit.max_limit
 )
-with ThreadPoolExecutor(max_workers=thread_count) as executor:
-    # Start the load operations and mark each future with its URL
-    future_list = [
-        executor.submit(process_s3_object, i, s3_object)
-        for i, s3_object in enumerate(s3_objects)
-    ]
-    for i, future in enumerate(as_completed(future_list)):
-        # Get the result so it re-raises any exceptions
-        future.result()
-        print(f"openjd_progress: {100 * i / len(s3_objects):.1f}\n", end="")
+with ThreadPoolExecutor(max_workers=executor_thread_count) as executor:
+    for shard_index in shard_indexes:
+        with hold_claim(claims, "HashObjects", shard_index, args.index):
+            process_shard(shard_index, executor)
+        processed_object_count += s3_object_count
+        processed_shard_count += 1
+ranged_get_executor.shutdown()
+hash_cache_executor.shutdown()
+if process_pool is not None:
+    process_pool.shutdown()
+if work_chunks is not None:
+    print(f"Claimed {processed_shard_count} of the {work_chunks['chunkCount']} chunks")
+if s3_bucket_name is not None and args.engine == "threads":
+    print(
+        f"The concurrency ended at {int(concurrency_limit.limit)} threads, ranging from {int(concurrency_limit.lowest_limit)} to {int(concurrency_limit.highest_limit)} with {concurrency_limit.decrease_count} decreases for S3 throttling"
+    )
+progress.close()
+if hash_cache is not None:
+    print(f"Used {hash_cache.hit_count} hashes from the hash cache")
+    hash_cache.close()
+if args.untagged_objects == "upload":
+    print(
+        f"Uploaded {uploaded_bytes_count} bytes in {uploaded_object_count} objects to the job attachments bucket"
+    )
+if skipped_object_count:
+    print(
+        f"Skipped {skipped_object_count} objects that were deleted or changed since the S3 Inventory report, and left them out of the manifest"
+    )
+metrics.write_summary(metrics_path(workspace_path, "HashObjects", args.index))
 print(
-    f"openjd_status: Processed {len(s3_objects)} objects (hashed {hashed_bytes_count} bytes in {hashed_object_count} objects)"
+    f"openjd_status: Processed {processed_object_count} objects (hashed {hashed_bytes_count} bytes in {hashed_object_count} objects)"
 )
 print("openjd_progress: 100")
-
-# Update the metadata about these objects in the workspace
-with open(workspace_path / f"s3_objects_{args.index}.json", "w") as fh:
-    json.dump(s3_objects, fh)
@@ -0,0 +1,477 @@
+"""
+Materializes a snapshot manifest that SaveManifest saved into a local directory, for example
+to prewarm the cache of a render node before its jobs start.
+
+To materialize the latest snapshot of a prefix:
+    $ PYTHONPATH=scripts/shared python scripts/materialize_snapshot.py \\
+        s3://JA_BUCKET/ROOT_PREFIX/Manifests/bucket-prefix-snapshot-BUCKET/PREFIX/TIMESTAMP-manifest.json \\
+        /local/cache/dir
+
+The manifest URL can also be of the index.json of the manifest partitions. The file data is
+downloaded from Data/<hash>.xxh128 under the job attachments root prefix, which is the part of
+the manifest key before /Manifests/ unless --job-attachments-root is given.
+
+Files that already have the size and mtime of the manifest are skipped, so running it again
+after an interruption only downloads what's left. Large files download with concurrent
+ranged GETs into partial files that record their finished parts, so an interrupted download
+resumes from its last part, and gets verified against its hash when it's done.
+
+Required permissions on the job attachments bucket:
+* s3:GetObject
+"""
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import sys
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path, PurePosixPath
+from urllib.parse import urlparse
+
+import boto3
+from xxhash import xxh3_128
+
+# This works because the "SharedLibrary" job environment sets PYTHONPATH, or the command sets it
+# like in the example above.
+from manifest_writer import ManifestReader
+from metrics import Metrics, metrics_path
+from progress import OBJECT_LOG_MODES, ProgressReporter
+from s3_client import create_s3_client, transfer_config
+
+parser = argparse.ArgumentParser(prog="materialize_snapshot.py")
+parser.add_argument(
+    "manifest_url",
+    help="The s3:// URL of a snapshot manifest, or of the index.json of its partitions.",
+)
+parser.add_argument("destination", type=Path)
+parser.add_argument(
+    "--job-attachments-root",
+    default="",
+    help="The s3://<bucket>/<root prefix> of the job attachments that hold the file data. "
+    + "Defaults to the part of the manifest URL before /Manifests/.",
+)
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=64,
+    help="How many files and ranged GET parts to download at the same time.",
+)
+parser.add_argument(
+    "--ranged-get-threshold",
+    type=int,
+    default=64 * 1024 * 1024,
+    help="Files of at least this many bytes are downloaded with concurrent ranged GETs.",
+)
+parser.add_argument(
+    "--part-size",
+    type=int,
+    default=16 * 1024 * 1024,
+    help="The size in bytes of each ranged GET part.",
+)
+parser.add_argument(
+    "--duplicates",
+    choices=["hardlink", "copy"],
+    default="hardlink",
+    help="Whether files with the same hash and mtime as one already materialized are hard links "
+    + "to it, or copies of it. Files with the same hash but a different mtime are always copies.",
+)
+parser.add_argument(
+    "--state-dir",
+    type=Path,
+    help="The directory for the partial downloads, downloaded manifests, metrics, and object log. "
+    + "Defaults to .<destination name>.materialize_snapshot next to the destination, which must "
+    + "be on the same file system as the destination.",
+)
+parser.add_argument(
+    "--object-log",
+    choices=OBJECT_LOG_MODES,
+    default="none",
+    help="Whether to write the log lines about each file to a compressed file in the state "
+    + "directory, print them, or drop them.",
+)
+parser.add_argument(
+    "--progress-interval",
+    type=float,
+    default=5,
+    help="How many seconds apart to report the progress.",
+)
+args = parser.parse_args()
+
+url = urlparse(args.manifest_url, allow_fragments=False)
+if url.scheme != "s3":
+    print(f"openjd_fail: The manifest {args.manifest_url} is not an s3:// URL")
+    sys.exit(1)
+manifest_bucket_name, manifest_key = url.netloc, url.path.lstrip("/")
+if args.job_attachments_root:
+    ja_url = urlparse(args.job_attachments_root, allow_fragments=False)
+    ja_s3_bucket_name, ja_root_prefix = ja_url.netloc, ja_url.path.strip("/")
+elif "/Manifests/" in manifest_key:
+    ja_s3_bucket_name = manifest_bucket_name
+    ja_root_prefix = manifest_key.partition("/Manifests/")[0]
+else:
+    print(
+        f"openjd_fail: The manifest {args.manifest_url} is not under a job attachments root prefix, provide --job-attachments-root"
+    )
+    sys.exit(1)
+
+destination = args.destination.absolute()
+state_dir = (
+    args.state_dir or destination.parent / f".{destination.name}.materialize_snapshot"
+)
+# The partial files are renamed into the destination when they're done, so that a file only
+# ever appears there with its full contents
+partials_dir = state_dir / "partials"
+manifests_dir = state_dir / "manifests"
+for directory in (destination, partials_dir, manifests_dir):
+    directory.mkdir(parents=True, exist_ok=True)
+
+session = boto3.Session()
+s3_client = create_s3_client(session, args.concurrency)
+metrics = Metrics("MaterializeSnapshot")
+progress = ProgressReporter(
+    args.object_log,
+    state_dir / "object_log.log.gz",
+    args.progress_interval,
+)
+metrics.instrument_client(s3_client)
+
+
+def download_manifest(key, max_concurrency):
+    """Downloads a manifest from the manifest bucket into the state directory, returning its path."""
+    local_path = manifests_dir / key.rsplit("/", 1)[-1]
+    s3_client.download_file(
+        manifest_bucket_name,
+        key,
+        str(local_path),
+        Config=transfer_config(max_concurrency),
+    )
+    return local_path
+
+
+def count_manifest_paths(manifest_path):
+    """Counts the paths of a manifest without parsing it."""
+    # JSON escapes the quotes inside strings, so '"path":' only appears as the key of a path
+    marker = b'"path":'
+    count = 0
+    tail = b""
+    with open(manifest_path, "rb") as fh:
+        while chunk := fh.read(16 * 1024 * 1024):
+            data = tail + chunk
+            count += data.count(marker)
+            tail = data[-(len(marker) - 1) :]
+    return count
+
+
+# Download the manifest, or all the partitions of an index
+print(f"Downloading the manifest {args.manifest_url}")
+if manifest_key.rsplit("/", 1)[-1] == "index.json":
+    response = s3_client.get_object(Bucket=manifest_bucket_name, Key=manifest_key)
+    manifest_index = json.load(response["Body"])
+    partitions_prefix = manifest_key.rsplit("/", 1)[0]
+    # The partitions download in parallel, so each one gets a single connection
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        manifest_paths = list(
+            executor.map(
+                lambda partition: download_manifest(
+                    f"{partitions_prefix}/{partition['fileName']}", 1
+                ),
+                manifest_index["partitions"],
+            )
+        )
+    total_count = manifest_index["pathCount"]
+    print(f"Downloaded {len(manifest_paths)} manifest partitions")
+else:
+    manifest_paths = [download_manifest(manifest_key, args.concurrency)]
+    total_count = count_manifest_paths(manifest_paths[0])
+print(f"Materializing {total_count} paths into {destination}")
+
+
+def iter_manifest_entries():
+    """Yields the path entries of the manifest, or of each partition in order."""
+    for manifest_path in manifest_paths:
+        with open(manifest_path, "rb") as fh:
+            reader = ManifestReader(fh)
+            if reader.hash_alg != "xxh128":
+                raise ValueError(
+                    f"The manifest uses the hash algorithm {reader.hash_alg}, only xxh128 is supported"
+                )
+            yield from reader
+
+
+def destination_path(path):
+    """Returns the path in the destination for a manifest path, which must stay inside it."""
+    parts = PurePosixPath(path).parts
+    if not parts or path.startswith("/") or ".." in parts:
+        raise ValueError(f"The manifest path {path!r} is outside of the destination")
+    return destination.joinpath(*parts)
+
+
+def data_key(file_hash):
+    return f"{ja_root_prefix}/Data/{file_hash}.xxh128"
+
+
+def hash_file(path):
+    """Returns the xxh128 hash of a file, reading it through a memory map."""
+    hasher = xxh3_128()
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mapped)
+    return hasher.hexdigest()
+
+
+def finish_file(partial_path, entry, dest, verify):
+    """Sets the mtime of a finished partial file, and renames it into the destination."""
+    if verify and (actual_hash := hash_file(partial_path)) != entry["hash"]:
+        os.remove(partial_path)
+        raise ValueError(
+            f"The resumed download of {entry['path']} has the hash {actual_hash} instead of {entry['hash']}"
+        )
+    os.utime(partial_path, ns=(entry["mtime"], entry["mtime"]))
+    os.replace(partial_path, dest)
+
+
+def download_file(i, entry, dest):
+    """Downloads a file smaller than --ranged-get-threshold with a single GET."""
+    progress.log_object(i, f"Downloading {entry['path']} ({entry['size']} bytes)")
+    partial_path = partials_dir / f"{entry['hash']}.partial"
+    response = s3_client.get_object(
+        Bucket=ja_s3_bucket_name, Key=data_key(entry["hash"])
+    )
+    with open(partial_path, "wb") as fh:
+        shutil.copyfileobj(response["Body"], fh, 1024 * 1024)
+        byte_count = fh.tell()
+    if byte_count != entry["size"]:
+        raise ValueError(
+            f"Downloaded {byte_count} bytes for {entry['path']} instead of {entry['size']}"
+        )
+    finish_file(partial_path, entry, dest, verify=False)
+    return True
+
+
+class RangedDownload:
+    """
+    The download of a large file with concurrent ranged GETs into a partial file. The parts
+    file next to it starts with the part size, and records each part that's finished, so that
+    a download interrupted with the same part size resumes with the parts that are left.
+    """
+
+    def __init__(self, i, entry, dest):
+        self.i = i
+        self.entry = entry
+        self.dest = dest
+        self.partial_path = partials_dir / f"{entry['hash']}.partial"
+        self.parts_path = partials_dir / f"{entry['hash']}.parts"
+        part_count = -(-entry["size"] // args.part_size)
+        finished_parts = set()
+        try:
+            if os.path.getsize(self.partial_path) == entry["size"]:
+                with open(self.parts_path) as fh:
+                    lines = fh.read().split("\n")
+                if lines[0] == str(args.part_size):
+                    # The last line is empty, or partial if the interruption cut it short
+                    finished_parts = {int(line) for line in lines[1:-1]}
+        except FileNotFoundError:
+            pass
+        self.resumed = bool(finished_parts)
+        if self.resumed:
+            progress.log_object(
+                i,
+                f"Resuming the download of {entry['path']} with {len(finished_parts)} of {part_count} parts done",
+            )
+        else:
+            with open(self.partial_path, "wb") as fh:
+                fh.truncate(entry["size"])
+            progress.log_object(
+                i,
+                f"Downloading {entry['path']} ({entry['size']} bytes) in {part_count} parts",
+            )
+        # Rewrite the parts file without any partial last line
+        self._parts_fh = open(self.parts_path, "w")
+        self._parts_fh.write(
+            "".join(f"{part}\n" for part in [args.part_size, *sorted(finished_parts)])
+        )
+        self._parts_fh.flush()
+        self._fd = os.open(self.partial_path, os.O_WRONLY)
+        self._lock = threading.Lock()
+        self.part_indexes = [
+            part for part in range(part_count) if part not in finished_parts
+        ]
+        self._remaining_count = len(self.part_indexes)
+
+    def download_part(self, part):
+        """Downloads a part into the partial file, returning True if it was the last one."""
+        start = part * args.part_size
+        end = min(start + args.part_size, self.entry["size"])
+        response = s3_client.get_object(
+            Bucket=ja_s3_bucket_name,
+            Key=data_key(self.entry["hash"]),
+            Range=f"bytes={start}-{end - 1}",
+        )
+        offset = start
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            os.pwrite(self._fd, chunk, offset)
+            offset += len(chunk)
+        if offset != end:
+            raise ValueError(
+                f"Downloaded {offset - start} bytes for part {part} of {self.entry['path']} instead of {end - start}"
+            )
+        progress.add(object_count=0, byte_count=end - start)
+        metrics.add_progress(byte_count=end - start)
+        with self._lock:
+            self._parts_fh.write(f"{part}\n")
+            self._parts_fh.flush()
+            self._remaining_count -= 1
+            if self._remaining_count > 0:
+                return False
+        return self.finish()
+
+    def finish(self):
+        """Renames the partial file into the destination once all the parts are done."""
+        os.close(self._fd)
+        self._parts_fh.close()
+        finish_file(self.partial_path, self.entry, self.dest, verify=self.resumed)
+        os.remove(self.parts_path)
+        return True
+
+
+def place_duplicate(i, entry, dest, source_path, source_mtime):
+    """Makes a file from another file already materialized with the same hash."""
+    link_path = partials_dir / f"duplicate_{i}"
+    if args.duplicates == "hardlink" and source_mtime == entry["mtime"]:
+        progress.log_object(i, f"Linking {entry['path']} to {source_path}")
+        os.link(source_path, link_path)
+        os.replace(link_path, dest)
+    else:
+        # Hard links share their mtime, so a duplicate with a different mtime gets a copy
+        progress.log_object(i, f"Copying {entry['path']} from {source_path}")
+        shutil.copyfile(source_path, link_path)
+        finish_file(link_path, entry, dest, verify=False)
+    return True
+
+
+skipped_count = 0
+downloaded_count = 0
+downloaded_bytes_count = 0
+duplicate_count = 0
+# For each hash, a (path, mtime) of a complete file with its data in the destination
+sources = {}
+# For each hash being downloaded, the entries with the same hash waiting for it
+waiting_duplicates = {}
+# Tasks to submit ahead of the manifest entries, for the duplicates of finished downloads
+ready_tasks = deque()
+created_dirs = set()
+
+
+def iter_tasks():
+    """
+    Yields (function, args, entry, dest) for each download, ranged GET part, and duplicate
+    that the manifest entries need, skipping the ones already in the destination. Each
+    function returns True when it finishes the file of the entry.
+    """
+    global skipped_count
+    for i, entry in enumerate(iter_manifest_entries()):
+        dest = destination_path(entry["path"])
+        try:
+            stat_result = os.stat(dest)
+        except FileNotFoundError:
+            stat_result = None
+        if (
+            stat_result is not None
+            and stat_result.st_size == entry["size"]
+            and stat_result.st_mtime_ns == entry["mtime"]
+        ):
+            skipped_count += 1
+            sources.setdefault(entry["hash"], (dest, entry["mtime"]))
+            progress.add()
+            metrics.add_progress(objects=1)
+            continue
+        if dest.parent not in created_dirs:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            created_dirs.add(dest.parent)
+        if entry["hash"] in waiting_duplicates:
+            waiting_duplicates[entry["hash"]].append((i, entry, dest))
+        elif entry["hash"] in sources:
+            source_path, source_mtime = sources[entry["hash"]]
+            yield place_duplicate, (
+                i,
+                entry,
+                dest,
+                source_path,
+                source_mtime,
+            ), entry, dest
+        elif entry["size"] < args.ranged_get_threshold:
+            waiting_duplicates[entry["hash"]] = []
+            yield download_file, (i, entry, dest), entry, dest
+        else:
+            waiting_duplicates[entry["hash"]] = []
+            ranged_download = RangedDownload(i, entry, dest)
+            for part in ranged_download.part_indexes:
+                yield ranged_download.download_part, (part,), entry, dest
+            if not ranged_download.part_indexes:
+                # Every part finished before the interruption, so only the rename is left
+                yield ranged_download.finish, (), entry, dest
+
+
+def file_finished(function, task_args, entry, dest):
+    """Counts a finished file, and queues the duplicates that were waiting for its data."""
+    global downloaded_count, downloaded_bytes_count, duplicate_count
+    if function is place_duplicate:
+        duplicate_count += 1
+        byte_count = 0
+    else:
+        downloaded_count += 1
+        downloaded_bytes_count += entry["size"]
+        sources[entry["hash"]] = (dest, entry["mtime"])
+        for i, duplicate_entry, duplicate_dest in waiting_duplicates.pop(entry["hash"]):
+            ready_tasks.append(
+                (
+                    place_duplicate,
+                    (i, duplicate_entry, duplicate_dest, dest, entry["mtime"]),
+                    duplicate_entry,
+                    duplicate_dest,
+                )
+            )
+        # The ranged GET parts counted their bytes as they finished
+        byte_count = entry["size"] if function is download_file else 0
+    progress.add(byte_count=byte_count)
+    metrics.add_progress(objects=1, byte_count=byte_count)
+
+
+progress.start("Materializing the snapshot", total_count)
+tasks = iter_tasks()
+pending = {}
+with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    while True:
+        # Keep twice as many tasks queued as there are threads, so they never run out
+        while len(pending) < 2 * args.concurrency:
+            if ready_tasks:
+                task = ready_tasks.popleft()
+            elif (task := next(tasks, None)) is None:
+                break
+            pending[executor.submit(task[0], *task[1])] = task
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            task = pending.pop(future)
+            if future.result():
+                file_finished(*task)
+progress.close()
+
+# Clean up the state directory, leaving the metrics and the object log
+shutil.rmtree(manifests_dir)
+shutil.rmtree(partials_dir)
+
+print(
+    f"Skipped {skipped_count} files that were already there, downloaded {downloaded_count} files "
+    + f"of {downloaded_bytes_count} bytes, and made {duplicate_count} duplicate files"
+)
+metrics.write_summary(metrics_path(state_dir, "MaterializeSnapshot"))
+print(f"openjd_status: Materialized {total_count} paths into {destination}")
+print("openjd_progress: 100")
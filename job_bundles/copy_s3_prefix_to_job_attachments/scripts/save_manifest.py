@@ -1,34 +1,56 @@
 import argparse
 import datetime
+import gzip
+import heapq
 import json
-import subprocess
+import shutil
 import sys
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from urllib.parse import urlparse
 
 import boto3
 
-subprocess.check_call([sys.executable, "-m", "pip", "install", "deadline"])
-from deadline.job_attachments.asset_manifests.v2023_03_03 import (
-    AssetManifest,
-    ManifestPath,
-)
+# This works because the "SharedLibrary" job environment sets PYTHONPATH.
+from copy_source import parse_copy_source, snapshot_prefix
+from manifest_writer import ManifestWriter, PartitionedManifestWriter, path_sort_key
+from metrics import Metrics, metrics_path
+from s3_client import create_s3_client, transfer_config
+from shard_records import carried_forward_path, encode_record, iter_records, shard_path
+from work_claims import S3Claims, load_work_chunks, shard_count
 
 parser = argparse.ArgumentParser(prog="collect_object.py")
 parser.add_argument("workspace_path", type=Path)
 parser.add_argument("--parallelism", type=int, required=True)
 parser.add_argument("--copy-source", type=str, required=True)
+parser.add_argument(
+    "--manifest-partitions",
+    choices=["none", "directory", "count"],
+    default="none",
+    help="Whether to also save the manifest split into partitions by top-level directory or "
+    + "by path count, with an index of the partitions.",
+)
+parser.add_argument(
+    "--manifest-partition-paths",
+    type=int,
+    default=1_000_000,
+    help="How many paths to put in each manifest partition when partitioning by count.",
+)
+parser.add_argument(
+    "--upload-concurrency",
+    type=int,
+    default=16,
+    help="How many manifest partitions to upload at the same time.",
+)
 args = parser.parse_args()
 
 workspace_path = Path(sys.argv[1])
 
 session = boto3.Session()
-s3_client = session.client("s3")
+s3_client = create_s3_client(session, args.upload_concurrency)
+metrics = Metrics("SaveManifest")
+metrics.instrument_client(s3_client)
 
-url = urlparse(args.copy_source, allow_fragments=False)
-s3_bucket_name = url.netloc
-s3_prefix = url.path.strip("/")
+s3_bucket_name, s3_prefix = parse_copy_source(args.copy_source)
 
 # Load the job attachments S3 settings
 with open(workspace_path / "job_attachment_settings.json") as fh:
@@ -36,28 +58,62 @@ with open(workspace_path / "job_attachment_settings.json") as fh:
 ja_s3_bucket_name = ja_settings["s3BucketName"]
 ja_root_prefix = ja_settings["rootPrefix"]
 
-total_size = 0
-paths = []
+# The manifest includes the objects of all the tasks, and the objects that an incremental
+# snapshot carried forward from the previous one. All their records are saved along with
+# the manifest, for the next incremental snapshot to compare against.
+record_paths = [
+    shard_path(workspace_path, index)
+    for index in range(1, shard_count(workspace_path, args.parallelism) + 1)
+]
+if carried_forward_path(workspace_path).exists():
+    record_paths.append(carried_forward_path(workspace_path))
 
-for index in range(1, args.parallelism + 1):
-    with open(workspace_path / f"s3_objects_{index}.json") as fh:
-        for s3_object in json.load(fh):
-            total_size += s3_object["size"]
-            paths.append(
-                ManifestPath(
-                    path=s3_object["key"][len(s3_prefix) + 1 :],
+
+def sorted_run(record_path):
+    """Yields (sort_key, s3_object) for the records of a file that is sorted in manifest order."""
+    for s3_object in iter_records(record_path):
+        yield path_sort_key(s3_object["key"]), s3_object
+
+
+# Each record file is already sorted in manifest order, so a k-way merge of them streams
+# the paths into the manifest in order. The objects all share the prefix, so sorting
+# by the object key gives the same order as sorting by the manifest path.
+manifest_path = workspace_path / "manifest.json"
+snapshot_records_path = workspace_path / "snapshot_objects.jsonl.gz"
+partitions_path = workspace_path / "manifest_partitions"
+partitioned_writer = None
+if args.manifest_partitions != "none":
+    shutil.rmtree(partitions_path, ignore_errors=True)
+    partitioned_writer = PartitionedManifestWriter(
+        partitions_path, args.manifest_partitions, args.manifest_partition_paths
+    )
+with open(manifest_path, "wb") as manifest_fh, gzip.open(
+    snapshot_records_path, "wb"
+) as snapshot_fh:
+    with ManifestWriter(manifest_fh) as manifest_writer:
+        for _, s3_object in heapq.merge(
+            *(sorted_run(record_path) for record_path in record_paths),
+            key=lambda item: item[0],
+        ):
+            path = s3_object["key"][len(s3_prefix) + 1 :]
+            manifest_writer.write_path(
+                path=path,
+                hash=s3_object["xxh128_hash"],
+                size=s3_object["size"],
+                mtime=s3_object["mtime"],
+            )
+            if partitioned_writer is not None:
+                partitioned_writer.write_path(
+                    path=path,
                     hash=s3_object["xxh128_hash"],
-                    mtime=s3_object["mtime"],
                     size=s3_object["size"],
+                    mtime=s3_object["mtime"],
                 )
-            )
-
-paths.sort(key=lambda x: x.path, reverse=True)
-
-manifest = AssetManifest(
-    hash_alg="xxh128",
-    paths=paths,
-    total_size=total_size,
+            snapshot_fh.write(encode_record(s3_object))
+if partitioned_writer is not None:
+    partitioned_writer.close()
+metrics.add_progress(
+    objects=manifest_writer.path_count, byte_count=manifest_writer.total_size
 )
 
 now_timestamp = (
@@ -65,12 +121,56 @@ now_timestamp = (
     .isoformat(timespec="minutes")
     .replace("+00:00", "Z")
 )
-manifest_key = f"{ja_root_prefix}/Manifests/bucket-prefix-snapshot-{s3_bucket_name}/{s3_prefix}/{now_timestamp}-manifest.json"
+manifest_prefix = snapshot_prefix(ja_root_prefix, s3_bucket_name, s3_prefix)
+manifest_key = f"{manifest_prefix}/{now_timestamp}-manifest.json"
 
-print(f"Saving manifest with {len(paths)} paths, total {total_size} bytes")
-s3_client.upload_fileobj(
-    Fileobj=BytesIO(manifest.encode().encode("utf-8")),
+print(
+    f"Saving manifest with {manifest_writer.path_count} paths, total {manifest_writer.total_size} bytes"
+)
+s3_client.upload_file(
+    Filename=str(manifest_path),
     Bucket=ja_s3_bucket_name,
     Key=manifest_key,
+    Config=transfer_config(args.upload_concurrency),
+)
+if partitioned_writer is not None:
+    # Upload the partitions next to their index in a folder named after the manifest, and
+    # the index last so that it only ever lists partitions that are there.
+    partitions_prefix = f"{manifest_prefix}/{now_timestamp}-manifest-partitions"
+    print(
+        f"Saving {len(partitioned_writer.partitions)} manifest partitions by {args.manifest_partitions}"
+    )
+    with ThreadPoolExecutor(max_workers=args.upload_concurrency) as executor:
+        for _ in executor.map(
+            lambda partition: s3_client.upload_file(
+                Filename=str(partitions_path / partition["fileName"]),
+                Bucket=ja_s3_bucket_name,
+                Key=f"{partitions_prefix}/{partition['fileName']}",
+                # The partitions upload in parallel, so each one gets a single connection
+                Config=transfer_config(1),
+            ),
+            partitioned_writer.partitions,
+        ):
+            pass
+    s3_client.upload_file(
+        Filename=str(partitioned_writer.index_path),
+        Bucket=ja_s3_bucket_name,
+        Key=f"{partitions_prefix}/{partitioned_writer.index_path.name}",
+    )
+    print(
+        f"openjd_status: Saved manifest partitions index url s3://{ja_s3_bucket_name}/{partitions_prefix}/{partitioned_writer.index_path.name}"
+    )
+# Save the object records after the manifest, so that an incremental snapshot only ever
+# finds records that have a manifest.
+s3_client.upload_file(
+    Filename=str(snapshot_records_path),
+    Bucket=ja_s3_bucket_name,
+    Key=f"{manifest_prefix}/{now_timestamp}-objects.jsonl.gz",
+    Config=transfer_config(args.upload_concurrency),
 )
+# Clean up the chunk claims that HashObjects and CopyObjects made in the job attachments bucket
+work_chunks = load_work_chunks(workspace_path)
+if work_chunks is not None and work_chunks["claimMethod"] == "s3":
+    S3Claims(s3_client, ja_s3_bucket_name, work_chunks["claimPrefix"]).delete_all()
+metrics.write_summary(metrics_path(workspace_path, "SaveManifest"))
 print(f"openjd_status: Saved manifest url s3://{ja_s3_bucket_name}/{manifest_key}")
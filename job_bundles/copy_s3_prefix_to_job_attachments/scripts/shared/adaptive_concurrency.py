@@ -0,0 +1,117 @@
+"""
+An adaptive limit on how many objects a step processes at the same time.
+
+The limit follows additive-increase, multiplicative-decrease (AIMD) like TCP congestion
+control. Each successful S3 request grows the limit by about one for every limit's worth
+of requests, while S3 responds quickly. When S3 throttles a request with a 503 SlowDown,
+the limit is multiplied by the backoff factor, at most once per cooldown period so that
+a burst of throttled requests only counts once. When the smoothed latency of an S3
+operation rises well above the lowest seen for that operation, its requests stop growing
+the limit. Each operation is tracked separately, because a large GetObject or UploadPart
+naturally takes much longer than a GetObjectTagging or HeadObject. The limit always stays
+within the minimum and maximum.
+
+This replaces the client-side rate limiter of botocore's "adaptive" retry mode, which also
+slows down on every throttled request. Instrument clients that use the "standard" retry
+mode, so that each throttled request isn't backed off twice.
+"""
+
+import threading
+import time
+
+# This works because the "SharedLibrary" job environment sets PYTHONPATH.
+from metrics import is_throttled
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Tracks the number of objects in flight against an adaptive limit. Call try_acquire
+    before starting an object and release when it's done, and instrument the S3 clients
+    with instrument_client to feed back their responses. All the methods are thread-safe.
+    """
+
+    def __init__(
+        self,
+        min_limit,
+        max_limit,
+        initial_limit,
+        backoff_factor=0.5,
+        cooldown_seconds=1.0,
+        latency_tolerance=3.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.backoff_factor = backoff_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.lowest_limit = self.limit
+        self.highest_limit = self.limit
+        self.decrease_count = 0
+        self._lock = threading.Lock()
+        self._last_decrease_time = 0.0
+        # The smoothed and lowest smoothed latency of each S3 operation
+        self._smoothed_latencies = {}
+        self._baseline_latencies = {}
+
+    def try_acquire(self):
+        """Returns True and counts an object in flight if there's room under the limit."""
+        with self._lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def release(self):
+        """Counts an object as no longer in flight."""
+        with self._lock:
+            self.in_flight -= 1
+
+    def instrument_client(self, s3_client):
+        """Registers event handlers on a boto3 or aiobotocore S3 client to adapt to its responses."""
+        events = s3_client.meta.events
+        events.register("before-call.s3", self._before_call)
+        events.register("after-call.s3", self._after_call)
+        events.register("needs-retry.s3", self._needs_retry)
+
+    def _before_call(self, context, **kwargs):
+        context["concurrency_start_time"] = time.perf_counter()
+
+    def _after_call(self, parsed, context, model, **kwargs):
+        start_time = context.get("concurrency_start_time")
+        if start_time is None or "Error" in parsed:
+            return
+        latency = time.perf_counter() - start_time
+        operation = model.name
+        with self._lock:
+            smoothed_latency = self._smoothed_latencies.get(operation)
+            if smoothed_latency is None:
+                smoothed_latency = latency
+            else:
+                smoothed_latency += 0.1 * (latency - smoothed_latency)
+            self._smoothed_latencies[operation] = smoothed_latency
+            baseline_latency = min(
+                smoothed_latency,
+                self._baseline_latencies.get(operation, smoothed_latency),
+            )
+            self._baseline_latencies[operation] = baseline_latency
+            if smoothed_latency <= self.latency_tolerance * baseline_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.highest_limit = max(self.highest_limit, self.limit)
+
+    def _needs_retry(self, response=None, **kwargs):
+        # This runs after every attempt of a request. It returns None so that it leaves
+        # the retry decision to the retry handler.
+        if response is None or not is_throttled(response):
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease_time < self.cooldown_seconds:
+                return
+            self._last_decrease_time = now
+            self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+            self.lowest_limit = min(self.lowest_limit, self.limit)
+            self.decrease_count += 1
+            limit = int(self.limit)
+        print(f"S3 throttled a request, reducing the concurrency to {limit}\n", end="")
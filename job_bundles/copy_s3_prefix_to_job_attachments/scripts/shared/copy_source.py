@@ -0,0 +1,80 @@
+"""
+The copy source that all the copy_s3_prefix_to_job_attachments steps take as --copy-source.
+
+The copy source is either an S3 prefix given as an s3:// URL, or a local directory given as an
+absolute path or a file:// URL. A local directory has to be on storage that all the workers
+mount at the same path, like an NFS or Lustre file system.
+
+The steps refer to each object by its key. For a local directory, the key of a file is its
+path without the leading "/", and the directory path without the leading "/" takes the place
+of the S3 prefix. That way, keys relate to the prefix the same way for both kinds of source.
+
+The record of a local file uses a stand-in for the S3 etag, built from the inode number,
+size, and mtime of the file. Like the etag, it changes when the file is replaced or modified,
+so the steps use it to check that each file is still the one that was listed.
+"""
+
+import mmap
+import os
+from urllib.parse import urlparse
+
+from xxhash import xxh3_128
+
+
+def parse_copy_source(copy_source):
+    """
+    Returns a tuple (bucket, prefix) for the copy source. The bucket is None for a local
+    directory. Raises ValueError if the copy source is neither an s3:// URL nor an absolute path.
+    """
+    url = urlparse(copy_source, allow_fragments=False)
+    if url.scheme == "s3":
+        return url.netloc, url.path.strip("/")
+    if url.scheme in ("", "file") and not url.netloc and url.path.startswith("/"):
+        return None, url.path.strip("/")
+    raise ValueError(
+        f"The copy source {copy_source} is not an s3:// URL or an absolute path"
+    )
+
+
+def snapshot_prefix(ja_root_prefix, bucket, prefix):
+    """Returns the prefix in the job attachments bucket that holds the snapshots of the copy source."""
+    if bucket is None:
+        return f"{ja_root_prefix}/Manifests/local-path-snapshot/{prefix}"
+    return f"{ja_root_prefix}/Manifests/bucket-prefix-snapshot-{bucket}/{prefix}"
+
+
+def local_file_path(key):
+    """Returns the path of the local file for a key."""
+    return f"/{key}"
+
+
+def local_etag(stat_result):
+    """Returns the stand-in for an etag of a local file from its os.stat result."""
+    return f"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+
+def open_unchanged_file(path, etag):
+    """
+    Opens a local file for reading in binary mode, and raises ValueError if it's not the
+    file with the listed etag.
+    """
+    fh = open(path, "rb")
+    if local_etag(os.fstat(fh.fileno())) != etag:
+        fh.close()
+        raise ValueError(f"The file {path} changed since it was listed")
+    return fh
+
+
+def hash_local_file(path, etag):
+    """
+    Returns the xxh128 hash of a local file, reading it through a memory map. This runs on
+    the worker processes of a process pool, so that hashing uses all the CPUs.
+    """
+    hasher = xxh3_128()
+    with open_unchanged_file(path, etag) as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mapped)
+    return hasher.hexdigest()
@@ -0,0 +1,144 @@
+"""
+A persistent cache of the job attachments hashes of S3 objects, so that runs of the
+copy_s3_prefix_to_job_attachments job that see the same objects again can skip
+all the S3 requests for them.
+
+The cache is a SQLite database mapping (bucket, key, etag) to (xxh128_hash, mtime). Because
+the etag changes whenever the object data changes, an entry stays valid for as long as
+the listing reports the same etag. When the cache holds more than max_entries entries,
+the least recently used ones are evicted as it is closed.
+
+The database uses a rollback journal rather than WAL mode. WAL mode coordinates its readers
+and writers through shared memory, which only works between processes on the same host. With
+a rollback journal, the processes coordinate through POSIX file locks, and wait for each
+other's writes up to the busy timeout. SQLite documents that these locks are unreliable on
+many network file systems, including NFS, so a cache is only safe to share between hosts on a
+file system with working POSIX locks. Otherwise, give each host its own local cache.
+
+New entries are buffered and saved in batches, so that the commits, which sync the database
+and the journal to disk, stay rare even on slow shared storage.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# How many cache hits to collect before recording them as used in one transaction
+_HIT_BATCH_SIZE = 10000
+# How many new entries to collect before saving them in one transaction
+_PUT_BATCH_SIZE = 1000
+# How long to wait for another process to finish writing to the cache
+_BUSY_TIMEOUT_SECONDS = 60
+
+
+class HashCache:
+    """
+    A thread-safe SQLite cache of object hashes. Multiple processes can share the file,
+    including the tasks on different hosts when it's on a shared file system with working
+    POSIX file locks.
+    """
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.hit_count = 0
+        self._lock = threading.Lock()
+        self._hits = []
+        # The entries that were put but aren't saved yet, by (bucket, key, etag)
+        self._puts = {}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(
+            path,
+            timeout=_BUSY_TIMEOUT_SECONDS,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        # Setting the journal mode also converts a cache that an earlier version of this
+        # job created in WAL mode.
+        self._connection.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_SECONDS * 1000}")
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                xxh128_hash TEXT NOT NULL,
+                mtime INTEGER NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (bucket, key, etag)
+            )""")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)"
+        )
+
+    def get(self, bucket, key, etag):
+        """Returns (xxh128_hash, mtime) for the object if it is in the cache, otherwise None."""
+        with self._lock:
+            row = self._puts.get((bucket, key, etag))
+            if row is not None:
+                self.hit_count += 1
+                return row
+            row = self._connection.execute(
+                "SELECT xxh128_hash, mtime FROM hashes WHERE bucket=? AND key=? AND etag=?",
+                (bucket, key, etag),
+            ).fetchone()
+            if row is not None:
+                self.hit_count += 1
+                self._hits.append((bucket, key, etag))
+                if len(self._hits) >= _HIT_BATCH_SIZE:
+                    self._record_hits()
+            return row
+
+    def put(self, bucket, key, etag, xxh128_hash, mtime):
+        """Adds the hash and mtime of the object to the cache, saving them with the next batch."""
+        with self._lock:
+            self._puts[(bucket, key, etag)] = (xxh128_hash, mtime)
+            if len(self._puts) >= _PUT_BATCH_SIZE:
+                self._save_puts()
+
+    def _save_puts(self):
+        """Saves the buffered entries in one transaction."""
+        now = int(time.time())
+        self._connection.execute("BEGIN")
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+            ((*entry, *value, now) for entry, value in self._puts.items()),
+        )
+        self._connection.execute("COMMIT")
+        self._puts = {}
+
+    def _record_hits(self):
+        """Updates the last used time of the entries that were hit."""
+        now = int(time.time())
+        self._connection.execute("BEGIN")
+        self._connection.executemany(
+            "UPDATE hashes SET last_used=? WHERE bucket=? AND key=? AND etag=?",
+            ((now, *hit) for hit in self._hits),
+        )
+        self._connection.execute("COMMIT")
+        self._hits = []
+
+    def close(self):
+        """
+        Saves the buffered entries, records which entries were used, evicts the least recently
+        used entries, and closes the cache.
+        """
+        with self._lock:
+            self._save_puts()
+            self._record_hits()
+            self._connection.execute("BEGIN")
+            (entry_count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM hashes"
+            ).fetchone()
+            if entry_count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                    (entry_count - self.max_entries,),
+                )
+            self._connection.execute("COMMIT")
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
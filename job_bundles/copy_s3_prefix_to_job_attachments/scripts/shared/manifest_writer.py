@@ -0,0 +1,233 @@
+"""
+A streaming writer for job attachments manifests in the v2023-03-03 format.
+
+The format is canonical JSON (RFC 8785) with no whitespace, sorted object keys, and the
+paths in the order of their UTF-16 code units. Because "totalSize" sorts after "paths",
+the manifest can be written one path at a time as long as the paths arrive in order,
+without holding the full list in memory or depending on the deadline package.
+
+PartitionedManifestWriter splits the same stream of paths into a set of smaller manifests,
+either one for each top-level directory or one for each run of a target number of paths,
+along with an index of them. Each partition is a complete manifest of its paths, so that
+workers can download and parse the partitions in parallel, or only the ones they need.
+
+ManifestReader parses a manifest in the same format back one path at a time, so that a
+consumer can stream a manifest with millions of paths without loading it whole.
+"""
+
+import io
+import json
+from pathlib import Path
+
+MANIFEST_VERSION = "2023-03-03"
+
+
+def path_sort_key(path):
+    """Returns the sort key that puts paths in manifest order."""
+    # Use the "surrogatepass" error handler because file names encountered in the wild
+    # include surrogates.
+    return path.encode("utf-16_be", errors="surrogatepass")
+
+
+class ManifestWriter:
+    """
+    Writes a manifest to a binary file object. Call write_path for each path in the
+    order of path_sort_key, then close to finish the manifest.
+    """
+
+    def __init__(self, fh, hash_alg="xxh128"):
+        self._fh = fh
+        self._last_sort_key = None
+        self.path_count = 0
+        self.total_size = 0
+        self._fh.write(
+            f'{{"hashAlg":{json.dumps(hash_alg)},"manifestVersion":"{MANIFEST_VERSION}","paths":['.encode()
+        )
+
+    def write_path(self, path, hash, size, mtime):
+        sort_key = path_sort_key(path)
+        if self._last_sort_key is not None and sort_key <= self._last_sort_key:
+            raise ValueError(f"Manifest path {path!r} is out of order")
+        self._last_sort_key = sort_key
+        separator = "," if self.path_count else ""
+        self._fh.write(
+            f'{separator}{{"hash":{json.dumps(hash)},"mtime":{int(mtime)},"path":{json.dumps(path)},"size":{int(size)}}}'.encode()
+        )
+        self.path_count += 1
+        self.total_size += size
+
+    def close(self):
+        self._fh.write(f'],"totalSize":{self.total_size}}}'.encode())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class PartitionedManifestWriter:
+    """
+    Writes manifest partitions and their index into a directory. Call write_path for each path
+    in the order of path_sort_key, then close to finish the partitions and write the index.
+    The index lists the file name of each partition relative to the index, with its first and
+    last path, path count, and total size.
+
+    With partition_by "directory", each top-level directory gets a partition, and the files at
+    the top level share one more. Because manifest order keeps each directory's paths together,
+    only the current directory's partition and the top level one are open at a time. With
+    partition_by "count", each partition holds the next max_path_count paths.
+    """
+
+    def __init__(self, directory, partition_by, max_path_count, hash_alg="xxh128"):
+        if partition_by not in ("directory", "count"):
+            raise ValueError(f"Unknown manifest partitioning {partition_by!r}")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / "index.json"
+        self.partition_by = partition_by
+        self.max_path_count = max_path_count
+        self.hash_alg = hash_alg
+        self.path_count = 0
+        self.total_size = 0
+        self.partitions = []
+        self._current = None
+        self._top_level = None
+
+    def _open_partition(self, top_level_directory=None):
+        file_name = f"part-{len(self.partitions) + 1:05d}.json"
+        fh = open(self.directory / file_name, "wb")
+        entry = {"fileName": file_name}
+        if self.partition_by == "directory":
+            entry["directory"] = top_level_directory
+        self.partitions.append(entry)
+        return {"fh": fh, "writer": ManifestWriter(fh, self.hash_alg), "entry": entry}
+
+    def _close_partition(self, partition):
+        partition["writer"].close()
+        partition["fh"].close()
+        partition["entry"]["pathCount"] = partition["writer"].path_count
+        partition["entry"]["totalSize"] = partition["writer"].total_size
+
+    def _partition_for(self, path):
+        if self.partition_by == "count":
+            if (
+                self._current is not None
+                and self._current["writer"].path_count >= self.max_path_count
+            ):
+                self._close_partition(self._current)
+                self._current = None
+            if self._current is None:
+                self._current = self._open_partition()
+            return self._current
+        top_level_directory, separator, _ = path.partition("/")
+        if not separator:
+            # Files at the top level, which are spread between the directories in manifest order
+            if self._top_level is None:
+                self._top_level = self._open_partition("")
+            return self._top_level
+        if (
+            self._current is not None
+            and self._current["entry"]["directory"] != top_level_directory
+        ):
+            self._close_partition(self._current)
+            self._current = None
+        if self._current is None:
+            self._current = self._open_partition(top_level_directory)
+        return self._current
+
+    def write_path(self, path, hash, size, mtime):
+        partition = self._partition_for(path)
+        partition["writer"].write_path(path, hash, size, mtime)
+        partition["entry"].setdefault("firstPath", path)
+        partition["entry"]["lastPath"] = path
+        self.path_count += 1
+        self.total_size += size
+
+    def close(self):
+        """Finishes the open partitions, and writes the index."""
+        for partition in (self._current, self._top_level):
+            if partition is not None:
+                self._close_partition(partition)
+        self._current = self._top_level = None
+        with open(self.index_path, "w") as fh:
+            json.dump(
+                {
+                    "hashAlg": self.hash_alg,
+                    "manifestVersion": MANIFEST_VERSION,
+                    "partitionBy": self.partition_by,
+                    "partitions": self.partitions,
+                    "pathCount": self.path_count,
+                    "totalSize": self.total_size,
+                },
+                fh,
+                indent=1,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class ManifestReader:
+    """
+    Reads the paths of a manifest from a binary file object. Iterate over it to get a dict for
+    each path with its "hash", "mtime", "path", and "size". The hash_alg and manifest_version
+    are read when it's created, and the total_size once all the paths are read.
+    """
+
+    def __init__(self, fh, chunk_size=1024 * 1024):
+        # JSON escapes the non-ASCII characters and the quotes inside strings, so the paths
+        # array starts at the first '"paths":['.
+        self._fh = io.TextIOWrapper(fh, encoding="utf-8")
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        while (paths_start := self._buffer.find('"paths":[')) < 0:
+            if not self._read_more():
+                raise ValueError("The manifest has no paths")
+        header = json.loads(self._buffer[:paths_start] + '"paths":[]}')
+        self.hash_alg = header["hashAlg"]
+        self.manifest_version = header["manifestVersion"]
+        if self.manifest_version != MANIFEST_VERSION:
+            raise ValueError(
+                f"Unsupported manifest version {self.manifest_version}, expected {MANIFEST_VERSION}"
+            )
+        self.total_size = None
+        self._pos = paths_start + len('"paths":[')
+
+    def _read_more(self):
+        chunk = self._fh.read(self._chunk_size)
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        return bool(chunk)
+
+    def __iter__(self):
+        first = True
+        while True:
+            if self._pos >= len(self._buffer) and not self._read_more():
+                raise ValueError("The manifest ends within its paths")
+            if self._buffer[self._pos] == "]":
+                break
+            if not first and self._buffer[self._pos] != ",":
+                raise ValueError("The manifest paths are not separated by commas")
+            try:
+                entry, end = self._decoder.raw_decode(
+                    self._buffer, self._pos + (0 if first else 1)
+                )
+            except json.JSONDecodeError:
+                # The path continues in the next chunk
+                if not self._read_more():
+                    raise
+                continue
+            first = False
+            self._pos = end
+            yield entry
+        while self._read_more():
+            pass
+        self.total_size = json.loads("{" + self._buffer[self._pos + 2 :])["totalSize"]
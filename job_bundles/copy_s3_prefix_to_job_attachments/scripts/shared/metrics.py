@@ -0,0 +1,240 @@
+"""
+Throughput and latency metrics for the copy_s3_prefix_to_job_attachments steps.
+
+Each step creates a Metrics object and instruments its S3 clients with it. The botocore
+event hooks record a latency histogram for each S3 operation, along with how many requests
+were throttled or failed and how many retries it took. The step reports the objects and
+bytes it processes to build a timeline of the throughput, and can time its own work like
+hashing the same way as the S3 operations. When the step finishes, it writes a JSON summary
+of everything into the metrics directory of the job workspace.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# The upper bounds in milliseconds of the latency histogram buckets. Latencies above
+# the last bound fall into an overflow bucket.
+LATENCY_BUCKET_BOUNDS_MS = (
+    1,
+    2,
+    5,
+    10,
+    20,
+    50,
+    100,
+    200,
+    500,
+    1000,
+    2000,
+    5000,
+    10000,
+    30000,
+    60000,
+)
+# S3 error codes and HTTP statuses that mean the request was throttled
+THROTTLE_ERROR_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+    "RequestThrottled",
+}
+THROTTLE_HTTP_STATUSES = {429, 503}
+
+
+def is_throttled(response):
+    """Returns whether an (http_response, parsed) response from botocore was throttled."""
+    http_response, parsed = response
+    return (
+        parsed.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+        or http_response.status_code in THROTTLE_HTTP_STATUSES
+    )
+
+
+def metrics_path(workspace_path, step_name, index=None):
+    """Returns the path of the JSON metrics summary for a step, or for a task of the step."""
+    file_name = step_name if index is None else f"{step_name}_{index}"
+    return Path(workspace_path) / "metrics" / f"{file_name}.json"
+
+
+class LatencyHistogram:
+    """A histogram of latencies with fixed log-scale buckets."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bucket_counts = [0] * (len(LATENCY_BUCKET_BOUNDS_MS) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        milliseconds = seconds * 1000
+        for i, bound in enumerate(LATENCY_BUCKET_BOUNDS_MS):
+            if milliseconds <= bound:
+                self.bucket_counts[i] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def percentile_ms(self, fraction):
+        """Returns the upper bound of the bucket that holds the given fraction of the latencies."""
+        rank = fraction * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                if i < len(LATENCY_BUCKET_BOUNDS_MS):
+                    return min(
+                        LATENCY_BUCKET_BOUNDS_MS[i], round(self.max_seconds * 1000, 1)
+                    )
+                break
+        return round(self.max_seconds * 1000, 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "meanMs": round(1000 * self.total_seconds / max(self.count, 1), 2),
+            "p50Ms": self.percentile_ms(0.5),
+            "p90Ms": self.percentile_ms(0.9),
+            "p99Ms": self.percentile_ms(0.99),
+            "maxMs": round(self.max_seconds * 1000, 1),
+            "bucketBoundsMs": list(LATENCY_BUCKET_BOUNDS_MS),
+            "bucketCounts": self.bucket_counts,
+        }
+
+
+class Metrics:
+    """Collects the metrics of one step. All the methods are thread-safe."""
+
+    def __init__(self, step_name, interval_seconds=10):
+        self.step_name = step_name
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._histograms = {}
+        self._operation_counts = {}
+        self._timeline = []
+        self.object_count = 0
+        self.byte_count = 0
+
+    def _operation(self, name):
+        if name not in self._operation_counts:
+            self._histograms[name] = LatencyHistogram()
+            self._operation_counts[name] = {
+                "errors": 0,
+                "retries": 0,
+                "throttled": 0,
+                "connectionErrors": 0,
+            }
+        return self._operation_counts[name]
+
+    def record_latency(self, operation, seconds):
+        """Records the latency of one call of an operation."""
+        with self._lock:
+            self._operation(operation)
+            self._histograms[operation].record(seconds)
+
+    @contextmanager
+    def timer(self, operation):
+        """A context manager that records how long its body takes as a call of the operation."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_latency(operation, time.perf_counter() - start_time)
+
+    def add_progress(self, objects=0, byte_count=0):
+        """Adds processed objects and bytes to the totals and the throughput timeline."""
+        with self._lock:
+            self.object_count += objects
+            self.byte_count += byte_count
+            interval = int(
+                (time.monotonic() - self._start_time) / self.interval_seconds
+            )
+            while len(self._timeline) <= interval:
+                self._timeline.append([0, 0])
+            self._timeline[interval][0] += objects
+            self._timeline[interval][1] += byte_count
+
+    def instrument_client(self, s3_client):
+        """Registers event handlers on a boto3 or aiobotocore S3 client to record its requests."""
+        events = s3_client.meta.events
+        events.register("before-call.s3", self._before_call)
+        events.register("after-call.s3", self._after_call)
+        events.register("needs-retry.s3", self._needs_retry)
+
+    def _before_call(self, context, **kwargs):
+        context["metrics_start_time"] = time.perf_counter()
+
+    def _after_call(self, model, parsed, context, **kwargs):
+        start_time = context.get("metrics_start_time")
+        if start_time is None:
+            return
+        seconds = time.perf_counter() - start_time
+        with self._lock:
+            counts = self._operation(model.name)
+            self._histograms[model.name].record(seconds)
+            counts["retries"] += parsed.get("ResponseMetadata", {}).get(
+                "RetryAttempts", 0
+            )
+            if "Error" in parsed:
+                counts["errors"] += 1
+
+    def _needs_retry(self, operation, response=None, caught_exception=None, **kwargs):
+        # This runs after every attempt of a request, to count the failed attempts. It
+        # returns None so that it leaves the retry decision to the retry handler.
+        if caught_exception is not None:
+            with self._lock:
+                self._operation(operation.name)["connectionErrors"] += 1
+        elif response is not None and is_throttled(response):
+            with self._lock:
+                self._operation(operation.name)["throttled"] += 1
+
+    def summary(self):
+        """Returns the metrics as a dict for the JSON summary."""
+        with self._lock:
+            elapsed_seconds = max(time.monotonic() - self._start_time, 1e-6)
+            return {
+                "step": self.step_name,
+                "elapsedSeconds": round(elapsed_seconds, 3),
+                "objectCount": self.object_count,
+                "byteCount": self.byte_count,
+                "objectsPerSecond": round(self.object_count / elapsed_seconds, 2),
+                "bytesPerSecond": round(self.byte_count / elapsed_seconds, 1),
+                "throughputTimeline": {
+                    "intervalSeconds": self.interval_seconds,
+                    "objectsPerSecond": [
+                        round(objects / self.interval_seconds, 2)
+                        for objects, _ in self._timeline
+                    ],
+                    "bytesPerSecond": [
+                        round(byte_count / self.interval_seconds, 1)
+                        for _, byte_count in self._timeline
+                    ],
+                },
+                "operations": {
+                    name: {**self._histograms[name].summary(), **counts}
+                    for name, counts in sorted(self._operation_counts.items())
+                },
+            }
+
+    def write_summary(self, path):
+        """Writes the JSON summary to path, and prints an overview of it."""
+        summary = self.summary()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as fh:
+            json.dump(summary, fh, indent=1)
+        print(
+            f"{self.step_name} metrics: {summary['objectsPerSecond']} objects/s, {summary['bytesPerSecond'] / 1024 / 1024:.2f}MB/s over {summary['elapsedSeconds']:.1f}s"
+        )
+        for name, operation in summary["operations"].items():
+            print(
+                f"  {name}: {operation['count']} calls, p50 {operation['p50Ms']}ms, p99 {operation['p99Ms']}ms, "
+                + f"{operation['retries']} retries, {operation['throttled']} throttled, {operation['errors']} errors"
+            )
+        print(f"Saved the metrics summary to {path}")
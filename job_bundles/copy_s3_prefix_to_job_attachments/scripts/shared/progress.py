@@ -0,0 +1,111 @@
+"""
+Rate-limited progress reporting for the HashObjects and CopyObjects tasks.
+
+With millions of objects in a shard, a log line for each step of each object, and an
+openjd_progress line for each object finished, make millions of unbuffered writes that slow
+down both the task and the log pipeline. Instead, the tasks count the finished objects in a
+ProgressReporter, which prints openjd_progress and openjd_status lines with the totals at
+most once every interval. A task that claims many chunks keeps counting in the same reporter,
+so that its percentage and time estimate cover all of its chunks instead of starting over at
+each one. The lines about each object go to an object log, which is a
+gzip-compressed file in the job workspace by default, or can be printed like before or
+dropped.
+"""
+
+import gzip
+import threading
+import time
+from pathlib import Path
+
+OBJECT_LOG_MODES = ("file", "stdout", "none")
+
+
+def object_log_path(workspace_path, step_name, index):
+    """Returns the path of the object log of a task of a step."""
+    return Path(workspace_path) / "object_logs" / f"{step_name}_{index}.log.gz"
+
+
+class ProgressReporter:
+    """Counts the finished objects of a task, and reports them at a bounded rate. All the methods are thread-safe."""
+
+    def __init__(self, object_log_mode, object_log_path, interval_seconds):
+        self.object_log_mode = object_log_mode
+        self.interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._object_log = None
+        if object_log_mode == "file":
+            object_log_path.parent.mkdir(parents=True, exist_ok=True)
+            # Append, so that a retried task adds to the log of the attempt before it
+            self._object_log = gzip.open(object_log_path, "at", encoding="utf-8")
+            print(f"Writing the log of each object to {object_log_path}")
+        self.description = ""
+        # The number of objects the task expects to process, and how many are in the shards
+        # or chunks it started so far
+        self.expected_count = 0
+        self.started_count = 0
+        self.completed_count = 0
+        self.byte_count = 0
+        self._start_time = time.monotonic()
+        self._start_count = 0
+        self._last_report_time = self._start_time
+
+    @property
+    def total_count(self):
+        return max(self.expected_count, self.started_count)
+
+    def expect(self, expected_count):
+        """Sets how many objects the task expects to process, across all the chunks it claims."""
+        with self._lock:
+            self.expected_count = expected_count
+
+    def start(self, description, total_count, completed_count=0):
+        """
+        Starts counting the objects of a shard or chunk, of which completed_count are already
+        done. The counts add up across the shards and chunks of the task.
+        """
+        with self._lock:
+            self.description = description
+            self.started_count += total_count
+            self.completed_count += completed_count
+            # Objects that an earlier attempt finished don't count towards the rate
+            self._start_count += completed_count
+
+    def log_object(self, i, message):
+        """Writes a line about object number i of the shard to the object log."""
+        if self.object_log_mode == "stdout":
+            # NOTE: If we don't combine "\n" inside the main string of print(), it interleaves the "\n"
+            #       with the bodies, and some lines get doubled up while others are empty.
+            print(f"{i}: {message}\n", end="")
+        elif self._object_log is not None:
+            with self._lock:
+                self._object_log.write(f"{i}: {message}\n")
+
+    def add(self, object_count=1, byte_count=0):
+        """Counts finished objects, and reports the progress if the interval has passed."""
+        with self._lock:
+            self.completed_count += object_count
+            self.byte_count += byte_count
+            now = time.monotonic()
+            if now - self._last_report_time >= self.interval_seconds:
+                self._last_report_time = now
+                self._report(now)
+
+    def _report(self, now):
+        percent = 100 * self.completed_count / max(self.total_count, 1)
+        rate = (self.completed_count - self._start_count) / max(
+            now - self._start_time, 1e-6
+        )
+        time_left = ""
+        if rate > 0:
+            remaining_minutes = (self.total_count - self.completed_count) / rate / 60
+            time_left = f", about {remaining_minutes:.1f} minutes left"
+        print(
+            f"openjd_progress: {percent:.1f}\n"
+            + f"openjd_status: {self.description}: {self.completed_count} of {self.total_count} objects done at {rate:.1f} objects/s, {self.byte_count / 1024 / 1024:.2f}MB processed{time_left}\n",
+            end="",
+        )
+
+    def close(self):
+        if self._object_log is not None:
+            self._object_log.close()
+            self._object_log = None
@@ -0,0 +1,62 @@
+"""
+The S3 client settings that all the steps share, so that connection reuse and retries are
+consistent and tuned in one place.
+
+A botocore client keeps a pool of 10 connections by default. When more threads than that
+make requests on one client, the extra threads wait for a connection to free up, and the
+connections they open past the pool get closed again after each request. Each step sizes the
+pool to the most requests its threads and transfers can have in flight at the same time, so
+that every thread reuses a warm connection.
+
+The clients retry in the "adaptive" mode, which adds a client-side rate limiter to the
+standard retries that slows the requests down when S3 responds with throttling errors, and
+they turn on TCP keepalive so that idle pooled connections aren't dropped by NAT gateways or
+load balancers between objects. A client whose step adapts its own concurrency to the
+throttling uses the "standard" mode instead, so that it doesn't slow down twice.
+
+The transfer settings are for the boto3 managed transfers, like upload_file and
+download_file. Each managed transfer runs its own threads for the parts, so a step that runs
+many of them at the same time gives each one fewer threads to keep within its pool.
+"""
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+RETRY_MODE = "adaptive"
+MAX_ATTEMPTS = 10
+# The boto3 defaults for managed transfers
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+
+def client_config_options(max_pool_connections, retry_mode=RETRY_MODE):
+    """Returns the client config options, for a botocore Config or an aiobotocore AioConfig."""
+    return {
+        "max_pool_connections": max(1, max_pool_connections),
+        "retries": {"mode": retry_mode, "max_attempts": MAX_ATTEMPTS},
+        "tcp_keepalive": True,
+    }
+
+
+def create_s3_client(session, max_pool_connections, retry_mode=RETRY_MODE):
+    """
+    Creates an S3 client from the boto3 session with a connection pool for up to
+    max_pool_connections requests at the same time.
+    """
+    return session.client(
+        "s3", config=Config(**client_config_options(max_pool_connections, retry_mode))
+    )
+
+
+def transfer_config(
+    max_concurrency,
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_CHUNKSIZE,
+):
+    """Returns the settings for managed transfers that each use up to max_concurrency connections."""
+    return TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+        max_concurrency=max(1, max_concurrency),
+        use_threads=max_concurrency > 1,
+    )
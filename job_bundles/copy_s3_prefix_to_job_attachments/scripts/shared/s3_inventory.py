@@ -0,0 +1,220 @@
+"""
+Reading S3 Inventory reports, so that CollectObjects can take the objects of a very large
+bucket from its inventory instead of listing them.
+
+An inventory report is a manifest.json that lists the data files of the report, along with
+their format and schema. S3 delivers each report to <config prefix>/<YYYY-MM-DDTHH-MMZ>/ in the
+destination bucket. CSV data files are gzip-compressed with no header row, hold the columns
+named by the fileSchema of the manifest in that order, and URL-encode the keys. Parquet data
+files have snake_case column names, and reading them requires the pyarrow package.
+
+The inventory has to include the Size, LastModifiedDate, and ETag fields. The ETag in the
+inventory has no quotes, so it gets quoted the way ListObjectsV2 returns it, for it to compare
+equal to the etags of listings and object tags.
+"""
+
+import csv
+import datetime
+import gzip
+import json
+import os
+import re
+from urllib.parse import unquote_plus, urlparse
+
+INVENTORY_MANIFEST_NAME = "manifest.json"
+# How many objects to yield at a time, the same as a ListObjectsV2 page
+BATCH_SIZE = 1000
+
+_REPORT_FOLDER = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$")
+# The CSV fileSchema field names and the Parquet column names of the fields that CollectObjects uses
+_CSV_FIELDS = {
+    "key": "Key",
+    "size": "Size",
+    "mtime": "LastModifiedDate",
+    "etag": "ETag",
+    "is_latest": "IsLatest",
+    "is_delete_marker": "IsDeleteMarker",
+}
+_PARQUET_FIELDS = {
+    "key": "key",
+    "size": "size",
+    "mtime": "last_modified_date",
+    "etag": "e_tag",
+    "is_latest": "is_latest",
+    "is_delete_marker": "is_delete_marker",
+}
+
+
+def find_inventory_manifest(s3_client, inventory_url):
+    """
+    Returns (bucket, key) of the inventory manifest at the s3:// URL. If the URL is not of a
+    manifest.json, it is the prefix of an inventory configuration, and this finds the manifest
+    of its most recent report. Raises ValueError if there is none.
+    """
+    url = urlparse(inventory_url, allow_fragments=False)
+    if url.scheme != "s3":
+        raise ValueError(f"The S3 Inventory {inventory_url} is not an s3:// URL")
+    bucket, key = url.netloc, url.path.lstrip("/")
+    if key.rsplit("/", 1)[-1] == INVENTORY_MANIFEST_NAME:
+        return bucket, key
+    # The report folders are named by their date and time, so the last one listed is the latest.
+    latest_folder = None
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket, Prefix=f"{key.rstrip('/')}/", Delimiter="/"
+    ):
+        for common_prefix in page.get("CommonPrefixes", []):
+            if _REPORT_FOLDER.search(common_prefix["Prefix"]):
+                latest_folder = common_prefix["Prefix"]
+    if latest_folder is None:
+        raise ValueError(f"The S3 Inventory {inventory_url} has no reports")
+    return bucket, f"{latest_folder}{INVENTORY_MANIFEST_NAME}"
+
+
+def load_inventory_manifest(s3_client, bucket, key, source_bucket):
+    """
+    Downloads the inventory manifest, and checks that it's an inventory of source_bucket
+    with the fields that CollectObjects needs. Raises ValueError if it isn't.
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    manifest = json.load(response["Body"])
+    if manifest["sourceBucket"] != source_bucket:
+        raise ValueError(
+            f"The S3 Inventory s3://{bucket}/{key} is of the bucket {manifest['sourceBucket']}, not {source_bucket}"
+        )
+    if manifest["fileFormat"] == "CSV":
+        fields = set(_csv_columns(manifest))
+    elif manifest["fileFormat"] == "Parquet":
+        # The fileSchema of a Parquet inventory is a Parquet message type definition
+        fields = {
+            csv_field
+            for name, csv_field in _CSV_FIELDS.items()
+            if re.search(rf"\b{_PARQUET_FIELDS[name]}\b", manifest["fileSchema"])
+        }
+    else:
+        raise ValueError(
+            f"The S3 Inventory s3://{bucket}/{key} is in {manifest['fileFormat']} format, only CSV and Parquet are supported"
+        )
+    missing_fields = [
+        _CSV_FIELDS[name]
+        for name in ("size", "mtime", "etag")
+        if _CSV_FIELDS[name] not in fields
+    ]
+    if missing_fields:
+        raise ValueError(
+            f"The S3 Inventory s3://{bucket}/{key} is missing the fields {', '.join(missing_fields)}, add them to the inventory configuration"
+        )
+    return manifest
+
+
+def inventory_creation_time(manifest):
+    """Returns the time S3 started the inventory report as a datetime."""
+    return datetime.datetime.fromtimestamp(
+        int(manifest["creationTimestamp"]) / 1000, tz=datetime.timezone.utc
+    )
+
+
+def inventory_data_bucket(manifest):
+    """Returns the bucket that holds the data files of the inventory report."""
+    # The destinationBucket is an ARN like arn:aws:s3:::bucket-name
+    return manifest["destinationBucket"].rsplit(":", 1)[-1]
+
+
+def _csv_columns(manifest):
+    return [column.strip() for column in manifest["fileSchema"].split(",")]
+
+
+def _to_record(key, size, mtime, etag):
+    return {
+        "key": key,
+        "size": int(size),
+        "etag": f'"{etag}"',
+        "mtime": int(mtime.timestamp() * 1e9),
+    }
+
+
+def _is_current_object(row, prefix):
+    """Returns whether the row is the current version of an object under the prefix."""
+    return (
+        row["key"].startswith(prefix)
+        and not row["key"].endswith("/")
+        and row.get("is_latest", True) in (True, "true")
+        and row.get("is_delete_marker", False) in (False, "false", "")
+    )
+
+
+def _iter_csv_rows(body, manifest):
+    columns = _csv_columns(manifest)
+    indexes = {
+        name: columns.index(csv_field)
+        for name, csv_field in _CSV_FIELDS.items()
+        if csv_field in columns
+    }
+    with gzip.open(body, "rt", newline="", encoding="utf-8") as fh:
+        for values in csv.reader(fh):
+            row = {name: values[i] for name, i in indexes.items()}
+            row["key"] = unquote_plus(row["key"])
+            yield row
+
+
+def iter_inventory_file(
+    s3_client, manifest, file_key, prefix, download_path, download_config=None
+):
+    """
+    Yields lists of up to BATCH_SIZE records for the objects under the prefix in an inventory
+    data file. A CSV file is streamed as it downloads. A Parquet file is downloaded to
+    download_path first with the download_config transfer settings, because it's read from
+    the end, and deleted afterwards.
+    """
+    bucket = inventory_data_bucket(manifest)
+    batch = []
+    if manifest["fileFormat"] == "CSV":
+        response = s3_client.get_object(Bucket=bucket, Key=file_key)
+        for row in _iter_csv_rows(response["Body"], manifest):
+            if _is_current_object(row, prefix):
+                batch.append(
+                    _to_record(
+                        row["key"],
+                        row["size"],
+                        datetime.datetime.fromisoformat(
+                            row["mtime"].replace("Z", "+00:00")
+                        ),
+                        row["etag"],
+                    )
+                )
+                if len(batch) == BATCH_SIZE:
+                    yield batch
+                    batch = []
+    else:
+        import pyarrow.parquet
+
+        s3_client.download_file(
+            bucket, file_key, str(download_path), Config=download_config
+        )
+        try:
+            parquet_file = pyarrow.parquet.ParquetFile(download_path)
+            columns = [
+                column
+                for column in _PARQUET_FIELDS.values()
+                if column in parquet_file.schema_arrow.names
+            ]
+            names = {column: name for name, column in _PARQUET_FIELDS.items()}
+            for record_batch in parquet_file.iter_batches(
+                batch_size=BATCH_SIZE, columns=columns
+            ):
+                for values in record_batch.to_pylist():
+                    row = {names[column]: value for column, value in values.items()}
+                    if _is_current_object(row, prefix):
+                        mtime = row["mtime"]
+                        if mtime.tzinfo is None:
+                            mtime = mtime.replace(tzinfo=datetime.timezone.utc)
+                        batch.append(
+                            _to_record(row["key"], row["size"], mtime, row["etag"])
+                        )
+                        if len(batch) == BATCH_SIZE:
+                            yield batch
+                            batch = []
+        finally:
+            os.remove(download_path)
+    if batch:
+        yield batch
@@ -0,0 +1,188 @@
+"""
+The record format for the lists of S3 objects that the copy_s3_prefix_to_job_attachments
+steps pass to each other through the job workspace.
+
+A record file holds one JSON array per line, with the values of FIELDS in order. Trailing
+fields that are not set yet, like the hash before HashObjects runs, are left off. Because
+each line stands alone, files can be read and appended to as streams without loading the
+whole list into memory.
+
+The "mtime" starts as the S3 LastModified time from the listing. When HashObjects replaces it
+with the POSIX mtime from the object metadata, it keeps the listed time in "listed_mtime",
+so that incremental snapshots can compare it against the next listing.
+
+Next to each record file, an index file holds the byte offset where each line starts as
+a little-endian uint64. RecordFile memory-maps both files for random access to the records.
+"""
+
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+FIELDS = ("key", "size", "etag", "mtime", "xxh128_hash", "listed_mtime")
+INDEX_SUFFIX = ".idx"
+_OFFSET = struct.Struct("<Q")
+
+
+def shard_path(workspace_path, index):
+    """Returns the path of the record file holding the objects for task number index."""
+    return Path(workspace_path) / f"s3_objects_{index}.jsonl"
+
+
+def copy_list_path(workspace_path, index):
+    """
+    Returns the path of the record file holding the objects that task number index
+    copies, with one object for each unique hash across all the tasks.
+    """
+    return Path(workspace_path) / f"s3_copies_{index}.jsonl"
+
+
+def uploaded_hashes_path(workspace_path, index):
+    """
+    Returns the path of the file listing the hashes, one per line, that HashObjects task
+    number index found in or uploaded to the job attachments bucket.
+    """
+    return Path(workspace_path) / f"s3_uploaded_{index}.txt"
+
+
+def carried_forward_path(workspace_path):
+    """
+    Returns the path of the record file holding the objects that an incremental snapshot
+    carries forward unchanged from the previous snapshot, without hashing or copying them.
+    """
+    return Path(workspace_path) / "s3_objects_carried_forward.jsonl"
+
+
+def listed_mtime(record):
+    """Returns the S3 LastModified time of a record's object as of its listing, in nanoseconds."""
+    return record.get("listed_mtime", record["mtime"])
+
+
+def encode_record(record):
+    """Encodes a record dict as a line of bytes."""
+    values = [record.get(field) for field in FIELDS]
+    while values and values[-1] is None:
+        values.pop()
+    return (
+        json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+    )
+
+
+def decode_record(line):
+    """Decodes a line of bytes into a record dict."""
+    return {
+        field: value
+        for field, value in zip(FIELDS, json.loads(line))
+        if value is not None
+    }
+
+
+def iter_records(path):
+    """Yields the records from a record file, one line at a time."""
+    with open(path, "rb") as fh:
+        for line in fh:
+            # Skip a partial line left by an interrupted append
+            if line.endswith(b"\n"):
+                yield decode_record(line)
+
+
+def count_records(path):
+    """Returns the number of records in a record file, from the size of its index."""
+    return os.path.getsize(f"{path}{INDEX_SUFFIX}") // _OFFSET.size
+
+
+class RecordWriter:
+    """Writes records to a record file and its index, appending if requested."""
+
+    def __init__(self, path, append=False):
+        mode = "ab" if append else "wb"
+        self._data_fh = open(path, mode)
+        self._index_fh = open(f"{path}{INDEX_SUFFIX}", mode)
+        self._offset = self._data_fh.tell()
+        self.count = self._index_fh.tell() // _OFFSET.size
+
+    def write(self, record):
+        line = encode_record(record)
+        self._data_fh.write(line)
+        self._index_fh.write(_OFFSET.pack(self._offset))
+        self._offset += len(line)
+        self.count += 1
+
+    def flush(self):
+        self._data_fh.flush()
+        self._index_fh.flush()
+
+    def close(self):
+        self._data_fh.close()
+        self._index_fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RecordFile:
+    """Provides memory-mapped random access to the records of a record file."""
+
+    def __init__(self, path):
+        self._mmaps = []
+        self._data = self._map(path)
+        self._index = self._map(f"{path}{INDEX_SUFFIX}")
+        self._count = len(self._index) // _OFFSET.size
+
+    def _map(self, path):
+        with open(path, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return b""
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(mapped)
+        return mapped
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("record index out of range")
+        (start,) = _OFFSET.unpack_from(self._index, i * _OFFSET.size)
+        end = self._data.find(b"\n", start) + 1
+        return decode_record(self._data[start:end])
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def close(self):
+        for mapped in self._mmaps:
+            mapped.close()
+        self._mmaps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_sorted_records(source_path, dest_path, sort_key):
+    """
+    Writes the records of the record file source_path to dest_path in the order of
+    sort_key(record), then deletes source_path. The sorted records replace dest_path
+    atomically, index first, so that an interruption never leaves it half written.
+    """
+    temp_path = f"{dest_path}.sorting"
+    with RecordFile(source_path) as records:
+        order = sorted(range(len(records)), key=lambda i: sort_key(records[i]))
+        with RecordWriter(temp_path) as writer:
+            for i in order:
+                writer.write(records[i])
+    os.replace(f"{temp_path}{INDEX_SUFFIX}", f"{dest_path}{INDEX_SUFFIX}")
+    os.replace(temp_path, dest_path)
+    os.remove(source_path)
+    os.remove(f"{source_path}{INDEX_SUFFIX}")
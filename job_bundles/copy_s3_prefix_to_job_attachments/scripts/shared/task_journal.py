@@ -0,0 +1,133 @@
+"""
+Checkpoint journals, so that a retried HashObjects or CopyObjects task resumes where the
+failed attempt stopped instead of starting over.
+
+As a task finishes each object of a shard, it appends a line to the shard's journal in the job
+workspace with the index of the object in the shard and what the task recorded for it, like
+the updated record with its hash and mtime, or whether it copied the object. The journal is
+flushed to disk every checkpoint interval. When a task is retried after a spot interruption
+or a timeout, it reads the journal back and skips the objects that are in it, so the retry
+only costs the unfinished remainder. A line left partial by the interruption is dropped, and
+its object processed again.
+
+The first line of a journal identifies the shard file it indexes into by its inode, size, and
+mtime. When the shard file was replaced since, the journal no longer applies to it. For
+HashObjects, which replaces its shard with the updated records when it's done, this means
+the shard is finished. CollectObjects deletes the journals when it writes new shards.
+"""
+
+import os
+import shutil
+import time
+from pathlib import Path
+
+JOURNALS_DIR_NAME = "journals"
+
+
+def journals_dir(workspace_path):
+    """Returns the directory in the workspace that holds the task journals."""
+    return Path(workspace_path) / JOURNALS_DIR_NAME
+
+
+def journal_path(workspace_path, step_name, shard_index):
+    """Returns the path of the journal for a step's shard."""
+    return journals_dir(workspace_path) / f"{step_name}_{shard_index}.journal"
+
+
+def delete_journals(workspace_path):
+    """Deletes all the task journals in the workspace."""
+    shutil.rmtree(journals_dir(workspace_path), ignore_errors=True)
+
+
+def _file_identity(path):
+    stat_result = os.stat(path)
+    return f"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+
+class TaskJournal:
+    """
+    An append-only journal of the objects of a shard that a task finished. Check completed[i]
+    to skip object i, and call write(i, payload) when object i is finished, where the payload
+    is a line of bytes ending in a newline. The writes must come from a single thread.
+    """
+
+    def __init__(self, path, shard_path, object_count, checkpoint_interval):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.checkpoint_interval = checkpoint_interval
+        self.completed = bytearray(object_count)
+        self.completed_count = 0
+        self.shard_replaced = False
+        self._identity = _file_identity(shard_path).encode()
+        self._fh = None
+        self._header_end = len(self._identity) + 1
+        self._last_checkpoint = time.monotonic()
+        try:
+            fh = open(self.path, "r+b")
+        except FileNotFoundError:
+            self.reset()
+            return
+        with fh:
+            header = fh.readline()
+            if header != self._identity + b"\n":
+                # A partial header means the journal was never used
+                self.shard_replaced = header.endswith(b"\n")
+                return
+            valid_end = fh.tell()
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    break
+                i = int(line[: line.index(b"\t")])
+                if not self.completed[i]:
+                    self.completed[i] = 1
+                    self.completed_count += 1
+                valid_end += len(line)
+            fh.truncate(valid_end)
+        self._fh = open(self.path, "ab")
+
+    def reset(self):
+        """Starts the journal over, for when the shard replaced since doesn't count as finished."""
+        if self._fh is not None:
+            self._fh.close()
+        self.completed = bytearray(len(self.completed))
+        self.completed_count = 0
+        self.shard_replaced = False
+        self._fh = open(self.path, "wb")
+        self._fh.write(self._identity + b"\n")
+        self.checkpoint()
+
+    def write(self, i, payload):
+        """Records that object i is finished, checkpointing if it's been long enough."""
+        self._fh.write(b"%d\t" % i + payload)
+        self.completed[i] = 1
+        self.completed_count += 1
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Flushes the journal through to the disk."""
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._last_checkpoint = time.monotonic()
+
+    def iter_payloads(self):
+        """Yields the payloads in the journal, in the order they were written."""
+        self._fh.flush()
+        with open(self.path, "rb") as fh:
+            fh.seek(self._header_end)
+            for line in fh:
+                yield line[line.index(b"\t") + 1 :]
+
+    def finish(self):
+        """
+        Truncates the journal to its header once the shard is replaced, so that it takes no
+        space while still recording that the shard is finished.
+        """
+        self._fh.truncate(self._header_end)
+        self.close()
+
+    def close(self):
+        if self._fh is not None:
+            self.checkpoint()
+            self._fh.close()
+            self._fh = None
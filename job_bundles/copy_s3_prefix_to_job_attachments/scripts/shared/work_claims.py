@@ -0,0 +1,398 @@
+"""
+Work claiming for the HashObjects and CopyObjects tasks.
+
+By default, CollectObjects splits the objects into one shard per task, and each task processes
+the shard matching its --index. When CollectObjects splits them into more chunks than there
+are tasks, each task instead claims one chunk at a time until there are none left. A task that
+runs on a slow host or hits a throttled key range claims fewer chunks, while the other tasks
+take over the chunks it hasn't started.
+
+A task claims a chunk by atomically creating a claim marker for it. With the "file" claim method,
+the marker is a lock file in the job workspace created with O_CREAT | O_EXCL, which requires
+the workspace to be on a file system that all the workers share. With the "s3" claim method, the
+marker is an object in the job attachments bucket written with a conditional PutObject that
+S3 rejects if the object already exists. Each marker holds the index of the task that claimed
+it, and a second marker records when the chunk is done, so that a retry of a failed task
+picks up the chunks it claimed but didn't finish.
+
+A claim is a lease that expires after the claim timeout. While a task processes a chunk, it
+renews the claim in the background, and when processing the chunk fails, it releases the
+claim. When a task's host is lost instead, its claim stops being renewed, and another task
+that comes across the chunk after the claim expired takes it over. The takeover is atomic:
+with the "s3" claim method, it's a PutObject conditional on the etag of the expired claim, and
+with the "file" claim method, it exclusively creates a takeover lock file named for the
+contents of the expired claim.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+WORK_CHUNKS_FILE_NAME = "work_chunks.json"
+DEFAULT_CLAIM_TIMEOUT_SECONDS = 600
+
+
+def save_work_chunks(
+    workspace_path,
+    task_count,
+    chunk_count,
+    claim_method,
+    claim_prefix=None,
+    claim_timeout_seconds=DEFAULT_CLAIM_TIMEOUT_SECONDS,
+):
+    """Saves how the objects are split into chunks into the workspace."""
+    with open(Path(workspace_path) / WORK_CHUNKS_FILE_NAME, "w") as fh:
+        json.dump(
+            {
+                "taskCount": task_count,
+                "chunkCount": chunk_count,
+                "claimMethod": claim_method,
+                "claimPrefix": claim_prefix,
+                "claimTimeoutSeconds": claim_timeout_seconds,
+            },
+            fh,
+        )
+
+
+def load_work_chunks(workspace_path):
+    """Loads how the objects are split into chunks, or returns None if they are one shard per task."""
+    path = Path(workspace_path) / WORK_CHUNKS_FILE_NAME
+    if not path.exists():
+        return None
+    with open(path) as fh:
+        work_chunks = json.load(fh)
+    if work_chunks["chunkCount"] <= work_chunks["taskCount"]:
+        return None
+    return work_chunks
+
+
+def shard_count(workspace_path, parallelism):
+    """Returns how many shards CollectObjects split the objects into."""
+    work_chunks = load_work_chunks(workspace_path)
+    return parallelism if work_chunks is None else work_chunks["chunkCount"]
+
+
+def file_claims_dir(workspace_path):
+    """Returns the directory in the workspace that holds the claim lock files."""
+    return Path(workspace_path) / "claims"
+
+
+def _claim_body(owner):
+    """
+    Returns the contents of a claim marker. It includes the time, so that every claim and
+    renewal has different contents, and a takeover can't match a renewal that came after it.
+    """
+    return json.dumps({"owner": owner, "time": time.time()}).encode()
+
+
+def _claim_owner(body):
+    """Returns the owner from the contents of a claim marker, or None if it's incomplete."""
+    try:
+        return json.loads(body)["owner"]
+    except (ValueError, KeyError):
+        return None
+
+
+class FileClaims:
+    """Claim markers as exclusively created lock files in a shared directory."""
+
+    def __init__(self, claims_dir, timeout_seconds=DEFAULT_CLAIM_TIMEOUT_SECONDS):
+        self.claims_dir = Path(claims_dir)
+        self.claims_dir.mkdir(parents=True, exist_ok=True)
+        self.timeout_seconds = timeout_seconds
+
+    def _path(self, step_name, chunk, suffix):
+        return self.claims_dir / f"{step_name}_{chunk}.{suffix}"
+
+    def _write_claim(self, step_name, chunk, owner):
+        # Replace the claim atomically, so that readers never see it partially written
+        path = self._path(step_name, chunk, "claim")
+        temp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}")
+        temp_path.write_bytes(_claim_body(owner))
+        os.replace(temp_path, path)
+
+    def try_claim(self, step_name, chunk, owner):
+        """Returns True if this call claimed the chunk, or False if it was already claimed."""
+        try:
+            fd = os.open(
+                self._path(step_name, chunk, "claim"),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+            )
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(_claim_body(owner))
+        return True
+
+    def owner(self, step_name, chunk):
+        """Returns the index of the task that claimed the chunk, or None."""
+        try:
+            return _claim_owner(self._path(step_name, chunk, "claim").read_bytes())
+        except FileNotFoundError:
+            return None
+
+    def renew(self, step_name, chunk, owner):
+        """Renews the task's claim on the chunk, or returns False if it lost the claim."""
+        if self.owner(step_name, chunk) != owner:
+            return False
+        self._write_claim(step_name, chunk, owner)
+        return True
+
+    def release(self, step_name, chunk, owner):
+        """Deletes the task's claim on the chunk, so that another task can claim it."""
+        if self.owner(step_name, chunk) == owner:
+            self._path(step_name, chunk, "claim").unlink(missing_ok=True)
+
+    def try_take_over(self, step_name, chunk, owner):
+        """Returns True if the chunk's claim expired and this call took it over."""
+        path = self._path(step_name, chunk, "claim")
+        try:
+            body = path.read_bytes()
+            if time.time() - path.stat().st_mtime < self.timeout_seconds:
+                return False
+        except FileNotFoundError:
+            return self.try_claim(step_name, chunk, owner)
+        # Only one task can create the takeover lock for these contents of the claim
+        claim_digest = hashlib.sha256(body).hexdigest()[:16]
+        try:
+            fd = os.open(
+                self._path(step_name, chunk, f"takeover-{claim_digest}"),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+            )
+        except FileExistsError:
+            return False
+        os.close(fd)
+        try:
+            if path.read_bytes() != body:
+                # The owner renewed the claim in the meantime
+                return False
+        except FileNotFoundError:
+            return self.try_claim(step_name, chunk, owner)
+        self._write_claim(step_name, chunk, owner)
+        return True
+
+    def mark_done(self, step_name, chunk):
+        self._path(step_name, chunk, "done").touch()
+
+    def is_done(self, step_name, chunk):
+        return self._path(step_name, chunk, "done").exists()
+
+
+class S3Claims:
+    """Claim markers as objects written with conditional PutObject requests."""
+
+    def __init__(
+        self, s3_client, bucket, prefix, timeout_seconds=DEFAULT_CLAIM_TIMEOUT_SECONDS
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.timeout_seconds = timeout_seconds
+        # The (etag, owner) of the claim marker that this task last wrote or read for each chunk
+        self._claims = {}
+
+    def _key(self, step_name, chunk, suffix):
+        return f"{self.prefix}/{step_name}_{chunk}.{suffix}"
+
+    def _conditional_put_claim(self, step_name, chunk, owner, **condition):
+        """
+        Writes the claim marker if the condition holds, and returns whether it did. The
+        condition is IfNoneMatch="*" for a new claim, or IfMatch with the etag of the claim.
+        """
+        while True:
+            try:
+                response = self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self._key(step_name, chunk, "claim"),
+                    Body=_claim_body(owner),
+                    **condition,
+                )
+                self._claims[(step_name, chunk)] = (response["ETag"], owner)
+                return True
+            except ClientError as exc:
+                error_code = exc.response["Error"]["Code"]
+                if error_code in ("PreconditionFailed", "NoSuchKey"):
+                    return False
+                if error_code != "ConditionalRequestConflict":
+                    raise
+            # S3 responds with a 409 conflict while another conditional write of the same key
+            # is in progress, so try again to find out which one won.
+            time.sleep(0.1)
+
+    def try_claim(self, step_name, chunk, owner):
+        """Returns True if this call claimed the chunk, or False if it was already claimed."""
+        return self._conditional_put_claim(step_name, chunk, owner, IfNoneMatch="*")
+
+    def owner(self, step_name, chunk):
+        """Returns the index of the task that claimed the chunk, or None."""
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket, Key=self._key(step_name, chunk, "claim")
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            return None
+        # Keep the etag, so that a retried task can renew the claim it finds it still owns
+        owner = _claim_owner(response["Body"].read())
+        self._claims[(step_name, chunk)] = (response["ETag"], owner)
+        return owner
+
+    def renew(self, step_name, chunk, owner):
+        """Renews the task's claim on the chunk, or returns False if it lost the claim."""
+        etag, claim_owner = self._claims.get((step_name, chunk), (None, None))
+        if claim_owner != owner:
+            return False
+        return self._conditional_put_claim(step_name, chunk, owner, IfMatch=etag)
+
+    def release(self, step_name, chunk, owner):
+        """Deletes the task's claim on the chunk, so that another task can claim it."""
+        if self.owner(step_name, chunk) == owner:
+            self.s3_client.delete_object(
+                Bucket=self.bucket, Key=self._key(step_name, chunk, "claim")
+            )
+
+    def try_take_over(self, step_name, chunk, owner):
+        """Returns True if the chunk's claim expired and this call took it over."""
+        try:
+            response = self.s3_client.head_object(
+                Bucket=self.bucket, Key=self._key(step_name, chunk, "claim")
+            )
+        except ClientError as exc:
+            if int(exc.response["ResponseMetadata"]["HTTPStatusCode"]) != 404:
+                raise
+            return self.try_claim(step_name, chunk, owner)
+        # Compare against the time of the response, so the clock of this host doesn't matter
+        now = parsedate_to_datetime(response["ResponseMetadata"]["HTTPHeaders"]["date"])
+        if (now - response["LastModified"]).total_seconds() < self.timeout_seconds:
+            return False
+        return self._conditional_put_claim(
+            step_name, chunk, owner, IfMatch=response["ETag"]
+        )
+
+    def mark_done(self, step_name, chunk):
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self._key(step_name, chunk, "done"), Body=b""
+        )
+
+    def is_done(self, step_name, chunk):
+        try:
+            self.s3_client.head_object(
+                Bucket=self.bucket, Key=self._key(step_name, chunk, "done")
+            )
+            return True
+        except ClientError as exc:
+            if int(exc.response["ResponseMetadata"]["HTTPStatusCode"]) != 404:
+                raise
+            return False
+
+    def delete_all(self):
+        """Deletes all the claim markers."""
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}/"):
+            objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if objects:
+                self.s3_client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True}
+                )
+
+
+def open_claims(work_chunks, workspace_path, s3_client, ja_s3_bucket_name):
+    """
+    Returns the FileClaims or S3Claims for the claim method in work_chunks, or None if the
+    tasks each process a fixed shard.
+    """
+    if work_chunks is None:
+        return None
+    timeout_seconds = work_chunks.get(
+        "claimTimeoutSeconds", DEFAULT_CLAIM_TIMEOUT_SECONDS
+    )
+    if work_chunks["claimMethod"] == "file":
+        return FileClaims(file_claims_dir(workspace_path), timeout_seconds)
+    return S3Claims(
+        s3_client, ja_s3_bucket_name, work_chunks["claimPrefix"], timeout_seconds
+    )
+
+
+def claim_chunks(claims, step_name, task_index, work_chunks):
+    """
+    Yields the chunks that the task claims, one at a time. Each chunk is only claimed once the
+    caller is done with the one before, and the caller marks it done with claims.mark_done.
+
+    The task first tries the chunks that a static split would assign to it, then the rest
+    from the end, away from where the other tasks are claiming their own chunks. It takes over
+    the chunks whose claims expired, and once it has tried them all, it tries the unfinished
+    ones again in case more claims expired in the meantime.
+    """
+    task_count = work_chunks["taskCount"]
+    chunk_count = work_chunks["chunkCount"]
+    own_chunks = list(range(task_index, chunk_count + 1, task_count))
+    other_chunks = [
+        chunk
+        for chunk in range(chunk_count, 0, -1)
+        if (chunk - 1) % task_count != task_index - 1
+    ]
+    unfinished_chunks = []
+    for chunk in own_chunks + other_chunks:
+        if claims.try_claim(step_name, chunk, task_index):
+            yield chunk
+        elif claims.is_done(step_name, chunk):
+            continue
+        elif claims.owner(step_name, chunk) == task_index:
+            # A previous attempt of this task claimed the chunk, but failed before finishing it
+            yield chunk
+        elif claims.try_take_over(step_name, chunk, task_index):
+            print(f"Took over chunk {chunk}, as its claim expired")
+            yield chunk
+        else:
+            unfinished_chunks.append(chunk)
+    for chunk in unfinished_chunks:
+        if not claims.is_done(step_name, chunk) and claims.try_take_over(
+            step_name, chunk, task_index
+        ):
+            print(f"Took over chunk {chunk}, as its claim expired")
+            yield chunk
+
+
+@contextmanager
+def hold_claim(claims, step_name, chunk, owner):
+    """
+    Holds the task's claim on the chunk for the duration of the block. The claim is renewed in
+    the background so that it doesn't expire, the chunk is marked done when the block finishes,
+    and the claim is released when the block raises, so that another task or a retry can claim
+    the chunk. With claims None, the tasks each process a fixed shard and there's no claim.
+    """
+    if claims is None:
+        yield
+        return
+    stop_renewing = threading.Event()
+
+    def renew_claim():
+        while not stop_renewing.wait(claims.timeout_seconds / 4):
+            try:
+                if not claims.renew(step_name, chunk, owner):
+                    print(f"Lost the claim on chunk {chunk} to another task")
+                    return
+            except Exception as exc:
+                print(f"Failed to renew the claim on chunk {chunk}: {exc}")
+
+    renew_thread = threading.Thread(target=renew_claim, daemon=True)
+    renew_thread.start()
+    try:
+        yield
+    except BaseException:
+        stop_renewing.set()
+        renew_thread.join()
+        claims.release(step_name, chunk, owner)
+        raise
+    stop_renewing.set()
+    renew_thread.join()
+    claims.mark_done(step_name, chunk)